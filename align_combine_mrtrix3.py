@@ -1,5 +1,6 @@
 #!/usr/bin/python3
 
+import contextlib
 import os, sys
 
 def usage(cmdline): #pylint: disable=unused-variable
@@ -15,15 +16,271 @@ def usage(cmdline): #pylint: disable=unused-variable
     cmdline.add_argument('-masks', help='Masks of input images', nargs='+')
     cmdline.add_argument('-interp', type=str, choices=["nearest", "linear", "cubic", "sinc"], default='cubic', help='Interpolation method. Default: cubic.')
     cmdline.add_argument('-iter', type=int, help='Number of iterations. Default: 3.', default=3)
+    cmdline.add_argument('-stream_average', action='store_true', help='Average the regridded images in Python as they are produced, instead of mrcat/mrmath/mrcalc.')
+    cmdline.add_argument('-parallel', type=int, default=1, help='Number of images registered and regridded concurrently. The available threads are split between these jobs. Default: 1.')
+    cmdline.add_argument('-tol_rotation', type=float, help='Rotation tolerance (degrees). With -tol_translation, images whose transform changed less than both tolerances since the previous iteration are not registered again, and iterations stop when all images converge.')
+    cmdline.add_argument('-tol_translation', type=float, help='Translation tolerance (mm), see -tol_rotation.')
+    cmdline.add_argument('-tol_ncc', type=float, help='With -tol_rotation and -tol_translation, also require 1 - NCC between the average and the previous one to be below this value to stop.')
+    cmdline.add_argument('-state', type=str, help='Directory that keeps transforms, regridded images and running sums between runs. When inputs are added or removed, only the new images are registered (to the previous output) and the average is updated.')
+    cmdline.add_argument('-full', action='store_true', help='With -state, redo all iterations for all inputs and replace the state.')
+    
+# run.command, recorded as a stage when MRI_TOOLKIT_TRACE is set. The usage
+# of its child processes is recorded when no other command runs at the same
+# time (e.g. with -parallel 1), see stage_trace.waited_children.
+def command(cmd, **kwargs):
+    from mrtrix3 import run #pylint: disable=no-name-in-module, import-outside-toplevel
+    from stage_trace import stage, waited_children #pylint: disable=import-outside-toplevel
+    
+    with stage(cmd.split()[0], command = cmd), waited_children():
+        run.command(cmd, **kwargs)
+    
+def register_and_regrid(img, it, ref_img, ref_mask, grid_temp, use_masks):
+    from mrtrix3 import app #pylint: disable=no-name-in-module, import-outside-toplevel
+    
+    transform = os.path.join('transforms' + str(it), 'img' + str(img) + '.txt')
+    opt_mov_mask = ' -mask1 ' + os.path.join('masks', 'img' + str(img) + '.nii') if use_masks else '' 
+    opt_ref_mask = ' -mask2 ' + ref_mask if use_masks else ''
+    opt_rig_init = '' if (it < 1) else  ' -rigid_init_matrix ' + os.path.join('transforms' + str(it-1), 'img' + str(img) + '.txt')
+    # Register
+    command('mrregister inputs/img' + str(img) + '.nii ' + ref_img + ' -type rigid -rigid ' + transform + opt_mov_mask + opt_ref_mask + opt_rig_init)
+    # Transform and regrid
+    command('mrtransform inputs/img' + str(img) + '.nii regrid_inputs/img' + str(img) + '.nii  -linear ' + transform + ' -template ' + grid_temp + ' -interp ' + app.ARGS.interp + ' -force')
+    command('mrtransform fovs/img' + str(img) + '.nii regrid_fovs/img' + str(img) + '.nii  -linear ' + transform + ' -template ' + grid_temp + ' -interp nearest -force')
+    return img
+
+# run.command adds '-nthreads N' (the run module's shared thread count) to
+# every MRtrix3 command, and that option takes precedence over any
+# -config NumberOfThreads. The per-job thread count is therefore set there,
+# while a pool of concurrent jobs is running.
+@contextlib.contextmanager
+def job_threads(n_threads):
+    from mrtrix3 import run #pylint: disable=no-name-in-module, import-outside-toplevel
+    
+    if n_threads is None:
+        yield
+        return
+    prev_threads = run.shared.get_num_threads()
+    prev_env = dict(run.shared.env)
+    run.shared.set_num_threads(n_threads)
+    try:
+        yield
+    finally:
+        run.shared.set_num_threads(prev_threads)
+        run.shared.env.clear()
+        run.shared.env.update(prev_env)
+
+# Add a regridded image and its FOV to the running sums (sign -1 removes them).
+# Non-finite voxels are skipped, as by mrmath sum, and not counted in the
+# FOV sum, so the sums never hold NaN and removing an image undoes adding it.
+def accumulate_regridded(img, img_sum, fov_sum, root = '.', sign = 1):
+    import nibabel as nib #pylint: disable=import-outside-toplevel
+    import numpy as np #pylint: disable=import-outside-toplevel
+    
+    regrid = nib.load(os.path.join(root, 'regrid_inputs', 'img' + str(img) + '.nii'))
+    fov = nib.load(os.path.join(root, 'regrid_fovs', 'img' + str(img) + '.nii'))
+    if img_sum is None:
+        # float64 sum, so the result does not depend on the order images finish
+        img_sum = np.zeros(regrid.shape, dtype=np.float64)
+        fov_sum = np.zeros(regrid.shape, dtype=np.float32)
+    values = np.asanyarray(regrid.dataobj, dtype=np.float32)
+    finite = np.isfinite(values)
+    img_sum += sign * np.where(finite, values, 0)
+    fov_sum += sign * np.where(finite, np.asanyarray(fov.dataobj, dtype=np.float32), 0)
+    return img_sum, fov_sum
+
+# Identity of an input file: changed files are treated as new inputs
+def input_key(fpath):
+    st = os.stat(fpath)
+    return {'path': os.path.abspath(fpath), 'mtime_ns': st.st_mtime_ns, 'size': st.st_size}
+
+# Settings that must match for the state to be reused
+def state_settings(use_masks):
+    from mrtrix3 import app #pylint: disable=no-name-in-module, import-outside-toplevel
+    return {
+        'grid': input_key(app.ARGS.grid),
+        'interp': app.ARGS.interp,
+        'iter': app.ARGS.iter,
+        'masks': use_masks,
+    }
+
+def read_state(state_dir):
+    import json #pylint: disable=import-outside-toplevel
+    fpath = os.path.join(state_dir, 'state.json')
+    if not os.path.isfile(fpath):
+        return None
+    with open(fpath) as f:
+        return json.load(f)
+
+# Copy the files of the images in scratch to the state (replacing all
+# previous ones, or only those of images no longer used), and save the
+# running sums
+def save_state(state_dir, images, settings, img_sum, fov_sum, replace = False):
+    import glob, json, shutil #pylint: disable=import-outside-toplevel
+    import numpy as np #pylint: disable=import-outside-toplevel
+    
+    if replace:
+        for sub in glob.glob(os.path.join(state_dir, '*', '')):
+            shutil.rmtree(sub)
+        if os.path.isfile(os.path.join(state_dir, 'bet_mask.nii.gz')):
+            os.remove(os.path.join(state_dir, 'bet_mask.nii.gz'))
+    for sub in ['regrid_inputs', 'regrid_fovs'] + sorted(glob.glob('transforms*')):
+        os.makedirs(os.path.join(state_dir, sub), exist_ok=True)
+        for fname in os.listdir(sub):
+            shutil.copyfile(os.path.join(sub, fname), os.path.join(state_dir, sub, fname))
+    keep = set('img' + img for img in images)
+    for fpath in glob.glob(os.path.join(state_dir, '*', 'img*')):
+        if os.path.basename(fpath).split('.')[0] not in keep:
+            os.remove(fpath)
+    for fname in ['output.nii', 'bet_mask.nii.gz']:
+        if os.path.isfile(fname):
+            shutil.copyfile(fname, os.path.join(state_dir, fname))
+    np.save(os.path.join(state_dir, 'sum.npy'), img_sum)
+    np.save(os.path.join(state_dir, 'fovsum.npy'), fov_sum)
+    with open(os.path.join(state_dir, 'state.json.tmp'), 'w') as f:
+        json.dump({'settings': settings, 'images': images}, f, indent=1)
+    os.replace(os.path.join(state_dir, 'state.json.tmp'), os.path.join(state_dir, 'state.json'))
+
+# Register only the added inputs to the previous output and update the sums
+def incremental_update(state_dir, state, keys, use_masks, n_jobs, n_threads):
+    import shutil #pylint: disable=import-outside-toplevel
+    import numpy as np #pylint: disable=import-outside-toplevel
+    from mrtrix3 import app, path #pylint: disable=no-name-in-module, import-outside-toplevel
+    from stage_trace import stage #pylint: disable=import-outside-toplevel
+    from concurrent.futures import ThreadPoolExecutor #pylint: disable=import-outside-toplevel
+    
+    known = {(k['path'], k['mtime_ns'], k['size']): img for img, k in state['images'].items()}
+    current = [(k['path'], k['mtime_ns'], k['size']) for k in keys]
+    removed = [img for key, img in known.items() if key not in current]
+    added = [i for i, key in enumerate(current) if key not in known]
+    app.console('Incremental update: ' + str(len(added)) + ' added, ' + str(len(removed)) + ' removed input(s)')
+    
+    img_sum = np.load(os.path.join(state_dir, 'sum.npy'))
+    fov_sum = np.load(os.path.join(state_dir, 'fovsum.npy'))
+    for img in removed:
+        img_sum, fov_sum = accumulate_regridded(img, img_sum, fov_sum, root = state_dir, sign = -1)
+    
+    images = {img: k for img, k in state['images'].items() if img not in removed}
+    next_id = max([int(img) for img in state['images']] + [-1]) + 1
+    new_ids = {i: str(next_id + n) for n, i in enumerate(added)}
+    for i, img in new_ids.items():
+        command('mrconvert ' + path.from_user(app.ARGS.inputs[i]) + ' ' + os.path.join('inputs','img' + img + '.nii'))
+        command('mrcalc ' + path.from_user(app.ARGS.inputs[i]) + ' -isnan -not ' + os.path.join('fovs','img' + img + '.nii'))
+        if use_masks:
+            command('mrconvert ' + path.from_user(app.ARGS.masks[i]) + ' ' + os.path.join('masks','img' + img + '.nii'))
+        images[img] = keys[i]
+    
+    # The previous output is the template and reference
+    for fname in ['output.nii', 'bet_mask.nii.gz']:
+        if os.path.isfile(os.path.join(state_dir, fname)):
+            shutil.copyfile(os.path.join(state_dir, fname), fname)
+    path.make_dir('transforms0')
+    with job_threads(n_threads), ThreadPoolExecutor(max_workers = n_jobs) as pool:
+        jobs = [pool.submit(register_and_regrid, img, 0, 'output.nii', 'bet_mask.nii.gz', 'output.nii', use_masks) for img in new_ids.values()]
+        for job in jobs:
+            img_sum, fov_sum = accumulate_regridded(job.result(), img_sum, fov_sum)
+    
+    with stage('stream_average', iteration = 'incremental'):
+        save_average(img_sum, fov_sum, 'output.nii', 'output.nii')
+    return images, img_sum, fov_sum
+
+# The intermediate output.nii is uncompressed; a .nii.gz output is gzipped
+# by several threads (nifti_output.py)
+def save_output():
+    from mrtrix3 import app, path #pylint: disable=no-name-in-module, import-outside-toplevel
+    
+    if app.ARGS.output.endswith('.nii.gz'):
+        from nifti_output import gzip_file #pylint: disable=import-outside-toplevel
+        gzip_file('output.nii', path.from_user(app.ARGS.output, False))
+    else:
+        command('mrconvert output.nii ' + path.from_user(app.ARGS.output),
+                    force=app.FORCE_OVERWRITE)
+
+# Rigid transform written by mrregister
+def read_transform(fpath):
+    import numpy as np #pylint: disable=import-outside-toplevel
+    return np.loadtxt(fpath, comments='#')[:3]
+
+# Rotation angle (degrees) and translation (mm) between two transforms
+def transform_change(fpath_prev, fpath):
+    import numpy as np #pylint: disable=import-outside-toplevel
+    prev, cur = read_transform(fpath_prev), read_transform(fpath)
+    rel = cur[:, :3] @ prev[:, :3].T
+    cos = np.clip((np.trace(rel) - 1) / 2, -1, 1)
+    return np.degrees(np.arccos(cos)), np.linalg.norm(cur[:, 3] - prev[:, 3])
+
+def load_output():
+    import nibabel as nib #pylint: disable=import-outside-toplevel
+    import numpy as np #pylint: disable=import-outside-toplevel
+    return np.asarray(nib.load('output.nii').dataobj, dtype=np.float64).ravel()
+
+# 1 - NCC between the average and the previous one (in memory)
+def output_change(prev_output):
+    from calculate_mi_kl_corr import norm_cross_corr #pylint: disable=import-outside-toplevel
+    return 1 - norm_cross_corr(prev_output, load_output())
+
+# Same as: mrcalc sum fovsum -div, set non-finite to 0, -abs
+def save_average(img_sum, fov_sum, template, out_path):
+    import nibabel as nib #pylint: disable=import-outside-toplevel
+    import numpy as np #pylint: disable=import-outside-toplevel
+    
+    with np.errstate(invalid='ignore', divide='ignore'):
+        out = (img_sum / fov_sum).astype(np.float32)
+    out[~np.isfinite(out)] = 0
+    np.abs(out, out=out)
+    header = nib.load(template).header.copy()
+    header.set_data_dtype(np.float32)
+    header.set_slope_inter(1, 0)
+    nib.save(nib.Nifti1Image(out, header.get_best_affine(), header), out_path)
     
 def execute(): #pylint: disable=unused-variable
-    from mrtrix3 import app, image, path, run #pylint: disable=no-name-in-module, import-outside-toplevel
+    from mrtrix3 import MRtrixError, app, image, path #pylint: disable=no-name-in-module, import-outside-toplevel
+    from stage_trace import stage #pylint: disable=import-outside-toplevel
+    from hdbet_batch import run_hdbet_batch #pylint: disable=import-outside-toplevel
+    from concurrent.futures import ThreadPoolExecutor, as_completed #pylint: disable=import-outside-toplevel
+    import shutil #pylint: disable=import-outside-toplevel
     
     app.check_output_path(app.ARGS.output)
     
     nLR = len(app.ARGS.inputs)
     app.console('Number of input images: ' + str(nLR))
     
+    # Split threads between concurrent image jobs
+    if app.ARGS.parallel < 1:
+        raise MRtrixError('-parallel must be a positive integer')
+    n_jobs = min(app.ARGS.parallel, nLR)
+    n_threads = None
+    if n_jobs > 1:
+        n_threads = max(1, (getattr(app.ARGS, 'nthreads', None) or os.cpu_count() or 1) // n_jobs)
+        app.console('Running ' + str(n_jobs) + ' jobs with ' + str(n_threads) + ' threads each')
+    
+    early_stop = app.ARGS.tol_rotation is not None or app.ARGS.tol_translation is not None
+    if early_stop and (app.ARGS.tol_rotation is None or app.ARGS.tol_translation is None):
+        raise MRtrixError('-tol_rotation and -tol_translation must be used together')
+    if app.ARGS.tol_ncc is not None and not early_stop:
+        raise MRtrixError('-tol_ncc requires -tol_rotation and -tol_translation')
+    
+    # Reuse the state of a previous run, if its settings match
+    use_masks = app.ARGS.masks is not None
+    state = None
+    if app.ARGS.state:
+        state_dir = os.path.abspath(app.ARGS.state)
+        keys = [input_key(imgpath) for imgpath in app.ARGS.inputs]
+        settings = state_settings(use_masks)
+        state = None if app.ARGS.full else read_state(state_dir)
+        if state is not None and state['settings'] != settings:
+            app.warn('Settings differ from those in ' + state_dir + ', running all iterations')
+            state = None
+        if state is not None and not os.path.isfile(os.path.join(state_dir, 'output.nii')):
+            app.warn('No previous output in ' + state_dir + ', running all iterations')
+            state = None
+        if state is not None and use_masks and not os.path.isfile(os.path.join(state_dir, 'bet_mask.nii.gz')):
+            app.warn('No brain mask of the previous output in ' + state_dir + ', running all iterations')
+            state = None
+        if state is not None and not any(key in state['images'].values() for key in keys):
+            app.warn('No input in common with ' + state_dir + ', running all iterations')
+            state = None
+        os.makedirs(state_dir, exist_ok=True)
+    
     # Make scratch directory 
     app.make_scratch_dir()
     app.goto_scratch_dir()
@@ -33,22 +290,29 @@ def execute(): #pylint: disable=unused-variable
     path.make_dir('regrid_inputs')
     path.make_dir('regrid_fovs')
     
+    if use_masks:
+        path.make_dir('masks')
+    
+    if state is not None:
+        images, img_sum, fov_sum = incremental_update(state_dir, state, keys, use_masks, n_jobs, n_threads)
+        save_state(state_dir, images, settings, img_sum, fov_sum)
+        save_output()
+        return
+    
     # Copy data to scratch directory
-    run.command('mrconvert ' + path.from_user(app.ARGS.grid) + ' grid.nii -config RealignTransform 0')
+    command('mrconvert ' + path.from_user(app.ARGS.grid) + ' grid.nii -config RealignTransform 0')
     # PENDING: print size and spacing
     
     for i,imgpath in enumerate(app.ARGS.inputs):
-        run.command('mrconvert ' + path.from_user(imgpath) + ' ' + os.path.join('inputs','img' + str(i) + '.nii'))
-        run.command('mrcalc ' + path.from_user(imgpath) + ' -isnan -not ' + os.path.join('fovs','img' + str(i) + '.nii'))
+        command('mrconvert ' + path.from_user(imgpath) + ' ' + os.path.join('inputs','img' + str(i) + '.nii'))
+        command('mrcalc ' + path.from_user(imgpath) + ' -isnan -not ' + os.path.join('fovs','img' + str(i) + '.nii'))
 
-    use_masks = False
-    if app.ARGS.masks is not None:
-        use_masks = True
-        path.make_dir('masks')
+    if use_masks:
         for i,imgpath in enumerate(app.ARGS.masks):
-            run.command('mrconvert ' + path.from_user(imgpath) + ' ' + os.path.join('masks','img' + str(i) + '.nii'))
+            command('mrconvert ' + path.from_user(imgpath) + ' ' + os.path.join('masks','img' + str(i) + '.nii'))
         
     # Start iterations
+    converged = set()
     for it in range(0, app.ARGS.iter):
         app.console('Starting iteration ' + str(it+1))
         
@@ -58,37 +322,73 @@ def execute(): #pylint: disable=unused-variable
             grid_temp = 'grid.nii'
 
         else:
-            ref_img = 'output.nii.gz' 
+            ref_img = 'output.nii' 
             ref_mask = 'bet_mask.nii.gz'
             grid_temp = ref_img
         
         path.make_dir('transforms' + str(it))
         
-        for img in range(nLR):
-            transform = os.path.join('transforms' + str(it), 'img' + str(img) + '.txt')
-            opt_mov_mask = ' -mask1 ' + os.path.join('masks', 'img' + str(img) + '.nii') if use_masks else '' 
-            opt_ref_mask = ' -mask2 ' + ref_mask if use_masks else ''
-            opt_rig_init = '' if (it < 1) else  ' -rigid_init_matrix ' + os.path.join('transforms' + str(it-1), 'img' + str(img) + '.txt')
-            # Register
-            run.command('mrregister inputs/img' + str(img) + '.nii ' + ref_img + ' -type rigid -rigid ' + transform + opt_mov_mask + opt_ref_mask + opt_rig_init)
-            # Transform and regrid
-            run.command('mrtransform inputs/img' + str(img) + '.nii regrid_inputs/img' + str(img) + '.nii  -linear ' + transform + ' -template ' + grid_temp + ' -interp ' + app.ARGS.interp + ' -force')
-            run.command('mrtransform fovs/img' + str(img) + '.nii regrid_fovs/img' + str(img) + '.nii  -linear ' + transform + ' -template ' + grid_temp + ' -interp nearest -force')
-            
+        # Converged images keep their transform and regridded image
+        for img in converged:
+            shutil.copyfile(os.path.join('transforms' + str(it-1), 'img' + str(img) + '.txt'), os.path.join('transforms' + str(it), 'img' + str(img) + '.txt'))
+        if converged:
+            app.console('Skipping ' + str(len(converged)) + ' converged image(s)')
+        
+        if early_stop and app.ARGS.tol_ncc is not None and it > 0:
+            prev_output = load_output()
+        
+        with job_threads(n_threads), ThreadPoolExecutor(max_workers = n_jobs) as pool:
+            jobs = [pool.submit(register_and_regrid, img, it, ref_img, ref_mask, grid_temp, use_masks) for img in range(nLR) if img not in converged]
+            img_sum = fov_sum = None
+            if app.ARGS.stream_average:
+                for img in converged:
+                    img_sum, fov_sum = accumulate_regridded(img, img_sum, fov_sum)
+            for job in as_completed(jobs):
+                img = job.result()
+                # Accumulate while the remaining images are registered
+                if app.ARGS.stream_average:
+                    img_sum, fov_sum = accumulate_regridded(img, img_sum, fov_sum)
              
         # Average (weighted by FOV)
-        run.command('mrcat ' + ' '.join(['regrid_inputs/img' + str(img) + '.nii' for img in range(nLR)]) + ' - | mrmath - sum tmp_sum.nii -axis 3 -force')
-        run.command('mrcat ' + ' '.join(['regrid_fovs/img' + str(img) + '.nii' for img in range(nLR)]) + ' - | mrmath - sum tmp_fovsum.nii -axis 3 -force')
-        run.command('mrcalc tmp_sum.nii tmp_fovsum.nii -div output.nii -force')
-        run.command('mrcalc output.nii -finite output.nii 0 -if -abs output.nii.gz -force')
+        if app.ARGS.stream_average:
+            with stage('stream_average', iteration = it):
+                save_average(img_sum, fov_sum, os.path.join('regrid_inputs', 'img0.nii'), 'output.nii')
+            del img_sum, fov_sum
+        else:
+            command('mrcat ' + ' '.join(['regrid_inputs/img' + str(img) + '.nii' for img in range(nLR)]) + ' - | mrmath - sum tmp_sum.nii -axis 3 -force')
+            command('mrcat ' + ' '.join(['regrid_fovs/img' + str(img) + '.nii' for img in range(nLR)]) + ' - | mrmath - sum tmp_fovsum.nii -axis 3 -force')
+            command('mrcalc tmp_sum.nii tmp_fovsum.nii -div tmp_div.nii -force')
+            command('mrcalc tmp_div.nii -finite tmp_div.nii 0 -if -abs output.nii -force')
+        
+        # Convergence of the transforms (and of the average)
+        if early_stop and it > 0:
+            changes = {img: transform_change(os.path.join('transforms' + str(it-1), 'img' + str(img) + '.txt'), os.path.join('transforms' + str(it), 'img' + str(img) + '.txt')) for img in range(nLR)}
+            app.console('Iteration ' + str(it+1) + ': max rotation change ' + '{:.4g}'.format(max(c[0] for c in changes.values())) + ' deg, max translation change ' + '{:.4g}'.format(max(c[1] for c in changes.values())) + ' mm')
+            converged = {img for img, (rot, trans) in changes.items() if rot < app.ARGS.tol_rotation and trans < app.ARGS.tol_translation}
+            done = len(converged) == nLR
+            if app.ARGS.tol_ncc is not None:
+                ncc_change = output_change(prev_output)
+                app.console('Iteration ' + str(it+1) + ': 1 - NCC with previous average ' + '{:.4g}'.format(ncc_change))
+                done = done and ncc_change < app.ARGS.tol_ncc
+            if done:
+                app.console('Converged after ' + str(it+1) + ' iterations')
+                break
         
         # Mask output
         if it < (app.ARGS.iter-1) and use_masks:
-            os.system('hd-bet -i output.nii.gz -o bet.nii.gz -device cpu -mode fast -tta 0 > /dev/null')
+            # Raises if HD-BET fails
+            if not run_hdbet_batch(['output.nii'], ['bet_mask.nii.gz'])[0]:
+                raise MRtrixError('HD-BET did not produce a brain mask of the average at iteration ' + str(it+1))
             
+    # Keep transforms, regridded images and sums for incremental updates
+    if app.ARGS.state:
+        img_sum = fov_sum = None
+        for img in range(nLR):
+            img_sum, fov_sum = accumulate_regridded(img, img_sum, fov_sum)
+        save_state(state_dir, {str(i): key for i, key in enumerate(keys)}, settings, img_sum, fov_sum, replace = True)
+    
     # Create output
-    run.command('mrconvert output.nii.gz ' + path.from_user(app.ARGS.output),
-                force=app.FORCE_OVERWRITE)
+    save_output()
             
 
 # Execute the script
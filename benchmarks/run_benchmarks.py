@@ -0,0 +1,209 @@
+#!/usr/bin/env python3
+# Throughput benchmarks on synthetic phantoms
+# Generates deterministic MRI-like phantoms (ellipsoidal head with CSF, GM
+# and WM, smooth bias field and Rician-like noise), measures voxels/s and
+# peak memory of the metric and combine functions, checks them against the
+# reference implementations, and compares with a stored baseline.
+# Diana Giraldo
+
+import argparse
+import json
+import os, sys
+import time
+import tracemalloc
+
+import numpy as np
+from scipy.ndimage import gaussian_filter
+from skimage.metrics import structural_similarity
+from skimage.util.arraycrop import crop
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import calculate_mi_kl_corr as mikl
+import calculate_ssim_psnr as ssim_psnr
+import combine_aligned_images as combine
+
+DEFAULT_SIZES = [128, 192, 256, 320]
+DEFAULT_N_INPUTS = [4, 8]
+DEFAULT_THRESHOLD = 0.2
+DEFAULT_REPEATS = 3
+SSIM_SIGMA = 1.5
+
+def make_phantom(size, seed = 0):
+    rng = np.random.default_rng(seed)
+    grid = np.stack(np.meshgrid(*[np.linspace(-1, 1, size, dtype=np.float32)] * 3, indexing='ij'))
+    r = np.sqrt(np.sum((grid / np.array([0.8, 0.9, 0.75], dtype=np.float32)[:, None, None, None]) ** 2, axis=0))
+    del grid
+
+    phantom = np.zeros((size,) * 3, dtype=np.float32)
+    phantom[r < 0.95] = 300   # CSF
+    phantom[r < 0.85] = 600   # GM
+    phantom[r < 0.6] = 900    # WM
+    texture = gaussian_filter(rng.standard_normal(phantom.shape).astype(np.float32), 2)
+    phantom += 40 * texture * (r < 0.95)
+    bias = gaussian_filter(rng.standard_normal(phantom.shape).astype(np.float32), size / 8)
+    return phantom * (1 + 0.1 * bias / bias.std())
+
+# Input images: phantom degraded with blur and noise
+def make_inputs(phantom, n_inputs, seed = 1):
+    rng = np.random.default_rng(seed)
+    inputs = []
+    for i in range(n_inputs):
+        img = gaussian_filter(phantom, 0.5 + 0.25 * i)
+        noise = rng.standard_normal((2,) + phantom.shape).astype(np.float32) * 20
+        inputs.append(np.sqrt((img + noise[0]) ** 2 + noise[1] ** 2))
+    return inputs
+
+# Best time of `repeats` runs, and the peak of Python-allocated memory
+# (tracemalloc) in one more, untimed run, so tracing does not slow the
+# timed ones
+def measure(func, n_voxels, repeats = DEFAULT_REPEATS):
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = func()
+        times.append(time.perf_counter() - start)
+    del result
+    tracemalloc.start()
+    result = func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, {'voxels_per_s': n_voxels / min(times), 'peak_mb': peak / 2**20}
+
+# Reference implementations for correctness checks. reference_fba is FBA as
+# first written, except that irfftn is given the input shape (s=, over all
+# axes), which the first version lacked: without it an odd last axis comes
+# back one voxel shorter.
+def reference_fba(img_list, p = combine.DEFAULT_FBA_P, sigma = combine.DEFAULT_FBA_SIGMA):
+    F_img = [np.fft.rfftn(img) for img in img_list]
+    W_img = [gaussian_filter(np.abs(fimg), sigma = sigma) ** p for fimg in F_img]
+    sum_W = np.sum(W_img, axis = 0)
+    U = np.sum([ fimg*(wimg/sum_W) for fimg, wimg in zip(F_img, W_img) ], axis = 0)
+    return np.fft.irfftn(U, s = img_list[0].shape, axes = range(U.ndim))
+
+def reference_entropy(x, y, bins = mikl.N_BINS):
+    jointhist, _, _ = np.histogram2d(x, y, bins = bins)
+    return mikl.entropy_measures_from_hist(jointhist)
+
+def reference_ssim(im, ref, data_range):
+    _, str_sim = structural_similarity(im, ref, data_range = data_range, gaussian_weights = True, sigma = SSIM_SIGMA, use_sample_covariance = False, full = True)
+    pad = (2 * int(3.5 * SSIM_SIGMA + 0.5)) // 2
+    return crop(str_sim, pad).mean(dtype=np.float64)
+
+# Equal up to rtol relative to the largest magnitude
+def close(a, b, rtol):
+    return bool(np.max(np.abs(np.asarray(a) - b)) <= rtol * np.max(np.abs(b)))
+
+def run_size(size, n_inputs_list, repeats):
+    results, checks = {}, {}
+    phantom = make_phantom(size).astype(np.float64)
+    inputs = [img.astype(np.float64) for img in make_inputs(phantom, max(n_inputs_list))]
+    n_vox = phantom.size
+    x, y = phantom.ravel(), inputs[0].ravel()
+
+    # MI / KL / NCC
+    (mi_ref, kl_ref), results['histogram2d'] = measure(lambda: reference_entropy(x, y), n_vox, repeats)
+    (mi, kl), results['entropy_measures'] = measure(lambda: mikl.entropy_measures(x, y), n_vox, repeats)
+    checks['entropy_measures'] = mi == mi_ref and kl == kl_ref
+    def binned_entropy():
+        ix, iy = mikl.bin_indices(x), mikl.bin_indices(y)
+        return mikl.entropy_measures_from_hist(mikl.joint_histogram(ix, iy))
+    (mi, kl), results['binned_entropy'] = measure(binned_entropy, n_vox, repeats)
+    checks['binned_entropy'] = mi == mi_ref and kl == kl_ref
+    _, results['norm_cross_corr'] = measure(lambda: mikl.norm_cross_corr(x, y), n_vox, repeats)
+
+    # SSIM
+    data_range = np.max(phantom)
+    ssim_ref, results['ssim'] = measure(lambda: reference_ssim(inputs[0], phantom, data_range), n_vox, repeats)
+    identity = np.array([[0, 1], [1, 1], [2, 1]])
+    stream, results['ssim_streaming'] = measure(
+        lambda: ssim_psnr.streaming_psnr_ssim(phantom, inputs[0], identity, max_memory = 256, sigma = SSIM_SIGMA),
+        n_vox, repeats,
+    )
+    checks['ssim_streaming'] = close(stream['SSIM'], ssim_ref, 1e-12)
+    pad = (2 * int(3.5 * SSIM_SIGMA + 0.5)) // 2
+    for dtype, rtol in [(np.float64, 1e-12), (np.float32, 1e-4)]:
+        name = f'ssim_slabs_{np.dtype(dtype).name}'
+        (ssim, _), results[name] = measure(
+            lambda: ssim_psnr.ssim_sums(inputs[0], phantom, data_range, pad, sigma = SSIM_SIGMA, dtype = dtype, workers = os.cpu_count()),
+            n_vox, repeats,
+        )
+        checks[name] = close(ssim, ssim_ref, rtol)
+
+    # Combine
+    for n_inputs in n_inputs_list:
+        imgs = inputs[:n_inputs]
+        for method in ['average', 'median']:
+            out, results[f'{method}_{n_inputs}'] = measure(lambda: combine.combine_images(imgs, method = method), n_vox * n_inputs, repeats)
+            stack = np.stack(imgs).astype(np.float32)
+            out_stack, results[f'{method}_stack_{n_inputs}'] = measure(lambda: combine.combine_stack(stack, method = method), n_vox * n_inputs, repeats)
+            ref = np.median(imgs, axis = 0) if method == 'median' else np.mean(imgs, axis = 0)
+            checks[f'{method}_{n_inputs}'] = close(out, ref, 0)
+            checks[f'{method}_stack_{n_inputs}'] = close(out_stack, ref, 1e-6)
+            del stack
+        out, results[f'fba_{n_inputs}'] = measure(lambda: combine.combine_images(imgs, method = 'fba'), n_vox * n_inputs, repeats)
+        checks[f'fba_{n_inputs}'] = close(out, reference_fba(imgs), 1e-6)
+
+    return results, checks
+
+def compare(results, baseline, threshold):
+    regressions = []
+    for key, res in results.items():
+        base = baseline.get(key)
+        if base is None:
+            continue
+        if res['voxels_per_s'] < base['voxels_per_s'] * (1 - threshold):
+            regressions.append(f"{key}: {res['voxels_per_s']:.3g} voxels/s (baseline {base['voxels_per_s']:.3g})")
+        if res['peak_mb'] > base['peak_mb'] * (1 + threshold):
+            regressions.append(f"{key}: {res['peak_mb']:.1f} MB peak (baseline {base['peak_mb']:.1f})")
+    return regressions
+
+#---------------------------------------------
+
+def main(args=None):
+
+    # Get inputs
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', nargs='+', type=int, default=DEFAULT_SIZES)
+    parser.add_argument('--n-inputs', nargs='+', type=int, default=DEFAULT_N_INPUTS)
+    parser.add_argument('--repeats', type=int, default=DEFAULT_REPEATS, help='Timed runs of each function (the best is kept); memory is measured in one more run.')
+    parser.add_argument('--output', type=str, default=None, help='JSON file to save the results (e.g. a new baseline).')
+    parser.add_argument('--baseline', type=str, default=None, help='JSON file with baseline results to compare with.')
+    parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD, help='Allowed relative slowdown or memory increase.')
+
+    args = parser.parse_args(args if args is not None else sys.argv[1:])
+
+    if args.repeats < 1:
+        raise ValueError('Number of repeats must be positive.')
+    if args.baseline and not os.path.isfile(args.baseline):
+        raise ValueError('Baseline file does not exist.')
+
+    results, failed = {}, []
+    for size in args.sizes:
+        size_results, checks = run_size(size, args.n_inputs, args.repeats)
+        for name, res in size_results.items():
+            key = f'{name}@{size}'
+            results[key] = res
+            print(f"{key:28s} {res['voxels_per_s']:12.4g} voxels/s {res['peak_mb']:10.1f} MB")
+        failed += [f'{name}@{size}' for name, ok in checks.items() if not ok]
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=1)
+        print("Results saved in", args.output)
+
+    regressions = []
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.threshold)
+
+    for name in failed:
+        print('Correctness check failed:', name)
+    for line in regressions:
+        print('Regression:', line)
+    if failed or regressions:
+        sys.exit(1)
+
+#---------------------------------------------
+if __name__ == '__main__':
+    main()
@@ -8,12 +8,81 @@ import argparse
 import numpy as np
 import pandas as pd
 
-import nibabel as nib
+from mask_index import LabelIndex, MaskIndex
+from nifti_cache import DEFAULT_CACHE_MAX_GB, load_volume
+from stage_trace import stage
 
 N_BINS = 16
+# Blocks of contiguous (masked) voxels resampled by the bootstrap
+N_BOOT_BLOCKS = 1024
+BOOT_CI = 0.95
+# Samples binned per chunk, bounding the temporary arrays for huge masks
+CHUNK_SIZE = 2**22
 
 def entropy_measures(x,y, bins = N_BINS, range=None):
-    jointhist, _, _ = np.histogram2d(x, y, bins = bins, range = range)
+    x_range, y_range = range if range is not None else (None, None)
+    jointhist = joint_histogram(bin_indices(x, bins, x_range), bin_indices(y, bins, y_range), bins)
+    return entropy_measures_from_hist(jointhist)
+
+# Edges as np.histogram2d builds them
+def bin_edges(x, bins = N_BINS, range=None):
+    if range is not None:
+        first_edge, last_edge = range
+    else:
+        first_edge, last_edge = x.min(), x.max()
+    if first_edge == last_edge:
+        first_edge, last_edge = first_edge - 0.5, last_edge + 0.5
+    return np.linspace(first_edge, last_edge, bins + 1)
+
+# Bin index of each sample, as np.histogram2d assigns them (-1 = outside range).
+# Indices are scaled to the uniform bins and then corrected against the
+# edges, so they match a search over the edges without sorting
+def bin_indices(x, bins = N_BINS, range=None, chunk_size = CHUNK_SIZE):
+    edges = bin_edges(x, bins, range)
+    # Bin k is [bounds[k+1], bounds[k+2]), for k = -1 (below) to bins (above)
+    bounds = np.concatenate(([-np.inf], edges, [np.inf]))
+    norm = bins / (edges[-1] - edges[0])
+
+    idx = np.empty(x.shape, dtype=np.int16 if bins < 2**15 else np.int32)
+    for start in np.arange(0, x.size, chunk_size):
+        xc = x[start:start + chunk_size]
+        f = (xc - edges[0]) * norm
+        np.floor(f, out=f)
+        np.clip(f, -1, bins, out=f)
+        f[np.isnan(f)] = bins
+        k = f.astype(np.intp)
+        k[xc < bounds[k + 1]] -= 1
+        k[xc >= bounds[k + 2]] += 1
+        k[xc == edges[-1]] = bins - 1
+        k[k >= bins] = -1
+        idx[start:start + chunk_size] = k
+    return idx
+
+# Joint counts of two bin index arrays, with outside-range samples counted
+# in an extra bin that is dropped at the end
+def joint_histogram(ix, iy, bins = N_BINS, chunk_size = CHUNK_SIZE):
+    n = bins + 1
+    jointhist = np.zeros(n * n, dtype=np.int64)
+    for start in np.arange(0, ix.size, chunk_size):
+        jointidx = (ix[start:start + chunk_size].astype(np.intp) + 1) * n
+        jointidx += iy[start:start + chunk_size]
+        jointidx += 1
+        jointhist += np.bincount(jointidx, minlength = n * n)
+    return jointhist.reshape(n, n)[1:,1:].astype(np.float64)
+
+# Joint histograms of each label (codes 0..n_labels-1), in one bincount
+def joint_histogram_labels(ix, iy, codes, n_labels, bins = N_BINS, chunk_size = CHUNK_SIZE):
+    n = bins + 1
+    jointhist = np.zeros(n_labels * n * n, dtype=np.int64)
+    for start in np.arange(0, ix.size, chunk_size):
+        jointidx = codes[start:start + chunk_size].astype(np.intp) * (n * n)
+        jointidx += (ix[start:start + chunk_size].astype(np.intp) + 1) * n
+        jointidx += iy[start:start + chunk_size]
+        jointidx += 1
+        jointhist += np.bincount(jointidx, minlength = n_labels * n * n)
+    return jointhist.reshape(n_labels, n, n)[:,1:,1:].astype(np.float64)
+
+def entropy_measures_from_hist(jointhist):
     pxy = jointhist/np.sum(jointhist)
     px = np.sum(pxy, axis=1)
     py = np.sum(pxy, axis=0)
@@ -36,22 +105,39 @@ def norm_cross_corr(x,y):
     corr = np.sqrt(np.dot(sx,sy)**2/(np.dot(sx,sx)*np.dot(sy,sy)))
     return corr
 
+# NCC of each label, from per-label sums of the centred samples
+def norm_cross_corr_labels(sx, sy, codes, n_labels):
+    sums = lambda w: np.bincount(codes, weights = w, minlength = n_labels)
+    n = sums(None)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mx, my = sums(sx)/n, sums(sy)/n
+        cxy = sums(sx*sy)/n - mx*my
+        cxx = sums(sx*sx)/n - mx*mx
+        cyy = sums(sy*sy)/n - my*my
+        return np.sqrt(cxy**2/(cxx*cyy))
+
 def calculate_similarity(
     ref_fpath,
     img_fpath_list,
     mask_fpath = None,
     mi_bins = N_BINS,
     mi_robust_max = False,
+    cache_dir = None,
+    cache_max_gb = DEFAULT_CACHE_MAX_GB,
 ):
+    load = lambda fpath: load_volume(fpath, cache_dir, max_gb = cache_max_gb)[0]
+
     # Load ref and mask
-    ref_array = nib.load(ref_fpath).get_fdata()
     if mask_fpath:
-        mask_array = nib.load(mask_fpath).get_fdata().astype(bool)
-        ref = ref_array[mask_array]
+        mask_index = MaskIndex(load(mask_fpath))
+        extract = lambda array: mask_index.gather(array, np.float64)
     else:
-        ref = ref_array.ravel()
+        extract = lambda array: np.asarray(array, dtype=np.float64).ravel()
+    ref = extract(load(ref_fpath))
     
-    if mi_robust_max: ref_max = np.percentile(ref, 99.75)*1.2
+    # Reference bins are the same for every image
+    ref_range = [0, np.percentile(ref, 99.75)*1.2] if mi_robust_max else None
+    ref_bins = bin_indices(ref, bins = mi_bins, range = ref_range)
 
     # Loop over img list
     MI = []
@@ -60,20 +146,13 @@ def calculate_similarity(
 
     for img_fpath in img_fpath_list:
         
-        img_array = nib.load(img_fpath).get_fdata()
-        
-        if mask_fpath:
-            img = img_array[mask_array]
-        else:
-            img = img_array.ravel()
+        img = extract(load(img_fpath))
             
-        if mi_robust_max: 
-            img_max = np.percentile(img, 99.75)*1.2
-            range = [[0, ref_max], [0, img_max]]
-        else:
-            range = None
+        img_range = [0, np.percentile(img, 99.75)*1.2] if mi_robust_max else None
 
-        mi,kl = entropy_measures(ref, img, bins = mi_bins, range = range)
+        with stage('histogram', image = img_fpath):
+            img_bins = bin_indices(img, bins = mi_bins, range = img_range)
+            mi,kl = entropy_measures_from_hist(joint_histogram(ref_bins, img_bins, bins = mi_bins))
         MI.append(mi)
         KL.append(kl)
         
@@ -82,55 +161,266 @@ def calculate_similarity(
 
     return MI, KL, NCC
 
+# Load, mask and bin a volume once, keeping what every pair needs. With a
+# LabelIndex, the samples of each label are binned separately.
+def prepare_volume(fpath, mask_index = None, mi_bins = N_BINS, mi_robust_max = False, cache_dir = None, cache_max_gb = DEFAULT_CACHE_MAX_GB):
+    array = load_volume(fpath, cache_dir, max_gb = cache_max_gb)[0]
+    if isinstance(mask_index, LabelIndex):
+        x = mask_index.gather_by_label(array, np.float64)
+        del array
+        with stage('binning', image = fpath):
+            return prepare_label_samples(x, mask_index.offsets, mi_bins = mi_bins, mi_robust_max = mi_robust_max)
+    if mask_index is not None:
+        x = mask_index.gather(array, np.float64)
+    else:
+        x = np.asarray(array, dtype=np.float64).ravel()
+    del array
+
+    with stage('binning', image = fpath):
+        return prepare_samples(x, mi_bins = mi_bins, mi_robust_max = mi_robust_max)
+
+# Bin indices and centred samples of a (masked) volume
+def prepare_samples(x, mi_bins = N_BINS, mi_robust_max = False):
+    range = [0, np.percentile(x, 99.75)*1.2] if mi_robust_max else None
+    sx = x - np.mean(x)
+    return {
+        'bins': bin_indices(x, bins = mi_bins, range = range),
+        'centred': sx,
+        'sumsq': np.dot(sx,sx),
+    }
+
+# prepare_samples of each label, for samples grouped by label (label k in
+# x[offsets[k]:offsets[k+1]]). Bins are those of each label alone.
+def prepare_label_samples(x, offsets, mi_bins = N_BINS, mi_robust_max = False):
+    n_labels = offsets.size - 1
+    labels = {
+        'bins': np.empty(x.shape, dtype=np.int16 if mi_bins < 2**15 else np.int32),
+        'centred': np.empty(x.shape, dtype=np.float64),
+        'sumsq': np.zeros(n_labels),
+        'codes': np.repeat(np.arange(n_labels, dtype=np.int32), np.diff(offsets)),
+        'offsets': offsets,
+    }
+    for k in range(n_labels):
+        a, b = offsets[k], offsets[k + 1]
+        if a == b:
+            continue
+        samples = prepare_samples(x[a:b], mi_bins = mi_bins, mi_robust_max = mi_robust_max)
+        labels['bins'][a:b] = samples['bins']
+        labels['centred'][a:b] = samples['centred']
+        labels['sumsq'][k] = samples['sumsq']
+    return labels
+
+# Samples of label k from prepare_label_samples
+def label_samples(labels, k):
+    a, b = labels['offsets'][k], labels['offsets'][k + 1]
+    return {'bins': labels['bins'][a:b], 'centred': labels['centred'][a:b], 'sumsq': labels['sumsq'][k]}
+
+def pair_similarity(ref, img, mi_bins = N_BINS):
+    with stage('histogram'):
+        jointhist = joint_histogram(ref['bins'], img['bins'], bins = mi_bins)
+    mi, kl = entropy_measures_from_hist(jointhist)
+    ncc = np.sqrt(np.dot(ref['centred'],img['centred'])**2/(ref['sumsq']*img['sumsq']))
+    return mi, kl, ncc
+
+# MI, KL and NCC of each label, from prepare_label_samples of the same labels
+def pair_similarity_labels(ref, img, mi_bins = N_BINS):
+    n_labels = ref['offsets'].size - 1
+    with stage('histogram'):
+        jointhist = joint_histogram_labels(ref['bins'], img['bins'], ref['codes'], n_labels, bins = mi_bins)
+    entropy = [entropy_measures_from_hist(h) for h in jointhist]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        ncc = norm_cross_corr_labels(ref['centred'], img['centred'], ref['codes'], n_labels)
+    return [e[0] for e in entropy], [e[1] for e in entropy], ncc
+
+# Bootstrap replicates of MI, KL and NCC. The samples are split into
+# n_blocks blocks of contiguous voxels, and the joint histogram and moments
+# of each block are computed once. Each replicate draws blocks with
+# multinomial weights, so its histogram and moments are weighted sums of
+# those of the blocks. Bins are kept fixed.
+def bootstrap_similarity(ref, img, n_boot, mi_bins = N_BINS, n_blocks = N_BOOT_BLOCKS, seed = None):
+    n = ref['bins'].size
+    n_blocks = max(1, min(n_blocks, n))
+    codes = (np.arange(n, dtype=np.int64) * n_blocks // n).astype(np.int32)
+
+    with stage('bootstrap'):
+        hists = joint_histogram_labels(ref['bins'], img['bins'], codes, n_blocks, bins = mi_bins)
+        sx, sy = ref['centred'], img['centred']
+        moments = np.stack([
+            np.bincount(codes, weights = w, minlength = n_blocks)
+            for w in [None, sx, sy, sx*sx, sy*sy, sx*sy]
+        ], axis = 1)
+
+        rng = np.random.default_rng(seed)
+        weights = rng.multinomial(n_blocks, np.full(n_blocks, 1/n_blocks), size = n_boot).astype(np.float64)
+        jointhists = (weights @ hists.reshape(n_blocks, -1)).reshape(n_boot, mi_bins, mi_bins)
+        entropy = [entropy_measures_from_hist(h) for h in jointhists]
+
+        N, Sx, Sy, Sxx, Syy, Sxy = (weights @ moments).T
+        cxy = Sxy/N - Sx*Sy/N**2
+        cxx = Sxx/N - (Sx/N)**2
+        cyy = Syy/N - (Sy/N)**2
+        ncc = np.sqrt(cxy**2/(cxx*cyy))
+
+    return {
+        'MI': np.array([e[0] for e in entropy]),
+        'KL1': np.array([e[1][0] for e in entropy]),
+        'KL2': np.array([e[1][1] for e in entropy]),
+        'NCC': ncc,
+    }
+
+# Basic bootstrap confidence interval of each metric, as CSV columns: the
+# percentiles q of the replicates are reflected around the estimate,
+# [2*estimate - q_high, 2*estimate - q_low]. Plug-in MI and KL are biased
+# upwards, and so are their replicates (drawn from the sample), so plain
+# percentile intervals can miss the estimate itself; the basic interval
+# corrects for that bias.
+def bootstrap_ci(replicates, estimates, ci = BOOT_CI):
+    q = [(1 - ci) / 2 * 100, (1 + ci) / 2 * 100]
+    columns = {}
+    for metric, values in replicates.items():
+        q_low, q_high = np.percentile(values, q)
+        columns[metric + '_ci_low'] = 2 * estimates[metric] - q_high
+        columns[metric + '_ci_high'] = 2 * estimates[metric] - q_low
+    return columns
+
+# N references x M images (or all pairs of images), loading each volume once
+def calculate_similarity_matrix(
+    ref_fpath_list,
+    img_fpath_list,
+    mask_fpath = None,
+    mi_bins = N_BINS,
+    mi_robust_max = False,
+    all_pairs = False,
+    labels_fpath = None,
+    n_boot = 0,
+    boot_ci = BOOT_CI,
+    boot_blocks = N_BOOT_BLOCKS,
+    seed = None,
+    cache_dir = None,
+    cache_max_gb = DEFAULT_CACHE_MAX_GB,
+):
+    mask_index = None
+    if mask_fpath:
+        mask_index = MaskIndex(load_volume(mask_fpath, cache_dir, max_gb = cache_max_gb)[0])
+    if labels_fpath:
+        mask_index = LabelIndex(load_volume(labels_fpath, cache_dir, max_gb = cache_max_gb)[0])
+
+    def prepare(fpath):
+        return prepare_volume(
+            fpath, mask_index, mi_bins = mi_bins, mi_robust_max = mi_robust_max,
+            cache_dir = cache_dir, cache_max_gb = cache_max_gb,
+        )
+
+    def row(ref_fpath, img_fpath, ref, img, mi, kl, ncc):
+        values = {'reference': ref_fpath, 'image': img_fpath, 'MI': mi, 'KL1': kl[0], 'KL2': kl[1], 'NCC': ncc}
+        if n_boot > 0:
+            replicates = bootstrap_similarity(ref, img, n_boot, mi_bins = mi_bins, n_blocks = boot_blocks, seed = seed)
+            values.update(bootstrap_ci(replicates, values, boot_ci))
+        return values
+
+    # One row per pair, or per pair and label
+    def pair_rows(ref_fpath, img_fpath, ref, img):
+        if not labels_fpath:
+            return [row(ref_fpath, img_fpath, ref, img, *pair_similarity(ref, img, mi_bins = mi_bins))]
+        rows = []
+        for k, (mi, kl, ncc) in enumerate(zip(*pair_similarity_labels(ref, img, mi_bins = mi_bins))):
+            label = mask_index.label_ids[k]
+            rows.append({
+                'label': int(label) if float(label).is_integer() else label,
+                **row(ref_fpath, img_fpath, label_samples(ref, k), label_samples(img, k), mi, kl, ncc),
+            })
+        return rows
+
+    rows = []
+    if all_pairs:
+        # Every image is compared with all the previous ones
+        prepared = []
+        for img_fpath in img_fpath_list:
+            img = prepare(img_fpath)
+            for ref_fpath, ref in prepared:
+                rows += pair_rows(ref_fpath, img_fpath, ref, img)
+            prepared.append((img_fpath, img))
+    else:
+        # Keep references in memory and stream the images
+        refs = [(ref_fpath, prepare(ref_fpath)) for ref_fpath in ref_fpath_list]
+        img_rows = [[] for _ in refs]
+        for img_fpath in img_fpath_list:
+            img = prepare(img_fpath)
+            for k, (ref_fpath, ref) in enumerate(refs):
+                img_rows[k] += pair_rows(ref_fpath, img_fpath, ref, img)
+        rows = [row for ref_rows in img_rows for row in ref_rows]
+
+    columns = ['reference', 'image'] + (['label'] if labels_fpath else []) + ['MI', 'KL1', 'KL2', 'NCC']
+    if n_boot > 0:
+        columns += [f'{m}_ci_{b}' for m in ['MI', 'KL1', 'KL2', 'NCC'] for b in ['low', 'high']]
+    return pd.DataFrame(rows, columns = columns)
+
 # -------------------------------------------------------
 
 def main(args=None):
     # Get inputs
     parser = argparse.ArgumentParser()
-    parser.add_argument('-r', '--reference', type=str, required=True)
+    parser.add_argument('-r', '--reference', nargs='+', default=None)
     parser.add_argument('-i', '--images', nargs='+', required=True)
     parser.add_argument('-o', '--output-file', type=str, required=True)
     parser.add_argument('-m', '--reference-mask', type=str, default=None)
+    parser.add_argument('-l', '--labels', type=str, default=None, help='Label atlas in reference space. Metrics are computed for each label.')
     parser.add_argument('--n-bins', type=int, default=N_BINS)
     parser.add_argument('--robust-max', action='store_true', default=False)
+    parser.add_argument('--all-pairs', action='store_true', default=False)
+    parser.add_argument('--bootstrap', type=int, default=0, help='Number of bootstrap replicates for confidence intervals (0: none).')
+    parser.add_argument('--bootstrap-ci', type=float, default=BOOT_CI, help='Confidence level of the intervals.')
+    parser.add_argument('--bootstrap-blocks', type=int, default=N_BOOT_BLOCKS, help='Number of blocks of contiguous voxels resampled.')
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--cache-dir', type=str, default=None, help='Directory to cache decoded volumes.')
+    parser.add_argument('--cache-max-gb', type=float, default=DEFAULT_CACHE_MAX_GB)
 
     args = parser.parse_args(args if args is not None else sys.argv[1:])
 
     # Check inputs
-    if not os.path.isfile(args.reference):
-        raise ValueError('Input reference does not exist.')
+    if args.all_pairs:
+        if args.reference:
+            raise ValueError('References are not used with --all-pairs.')
+    elif not args.reference:
+        raise ValueError('At least one reference is required (or use --all-pairs).')
+
+    for ref_fpath in args.reference or []:
+        if not os.path.isfile(ref_fpath):
+            raise ValueError(f'Input reference {ref_fpath} does not exist.')
 
     if args.reference_mask and not os.path.isfile(args.reference_mask):
         raise ValueError('Reference mask image does not exist.')
 
+    if args.labels and not os.path.isfile(args.labels):
+        raise ValueError('Label image does not exist.')
+
+    if args.labels and args.reference_mask:
+        raise ValueError('Use either a reference mask or labels.')
+
+    if args.bootstrap < 0 or not 0 < args.bootstrap_ci < 1:
+        raise ValueError('Invalid bootstrap options.')
+
     for i,img_fpath in enumerate(args.images):
         if not os.path.isfile(img_fpath):
            raise ValueError(f'Input image {img_fpath} does not exist.') 
 
-    # Initialize dataframe with results
-    n_imgs = len(args.images)
-    result = pd.DataFrame(
-        {
-            'reference': [args.reference]*n_imgs,
-            'image': args.images
-        }
-    )
-
-    # Calculate similarity measures
-    MI, KL, NCC = calculate_similarity(
+    # Calculate similarity measures (one row per reference-image pair, and label)
+    result = calculate_similarity_matrix(
         args.reference,
         args.images,
         mask_fpath = args.reference_mask,
         mi_bins = args.n_bins,
         mi_robust_max = args.robust_max,
+        all_pairs = args.all_pairs,
+        labels_fpath = args.labels,
+        n_boot = args.bootstrap,
+        boot_ci = args.bootstrap_ci,
+        boot_blocks = args.bootstrap_blocks,
+        seed = args.seed,
+        cache_dir = args.cache_dir,
+        cache_max_gb = args.cache_max_gb,
     )
 
-    # Populate DF
-    result['MI'] = MI
-    result['KL1'] = [kl[0] for kl in KL]
-    result['KL2'] = [kl[1] for kl in KL]
-    result['NCC'] = NCC
-
     # Save
     result.to_csv(args.output_file, index=False)
     print("Results saved in ", args.output_file)
@@ -5,13 +5,283 @@
 
 import os, sys
 import argparse
+import tempfile
 import numpy as np
 import pandas as pd
 
 import nibabel as nib
 
-from skimage.metrics import structural_similarity
-from skimage.util.arraycrop import crop
+from concurrent.futures import ThreadPoolExecutor
+
+from scipy.ndimage import gaussian_filter, uniform_filter
+
+from mask_index import MaskIndex
+from nifti_cache import DEFAULT_CACHE_MAX_GB, load_volume
+from nifti_output import scratch_dir, uncompressed_input
+from stage_trace import stage
+
+# Defaults of skimage.metrics.structural_similarity
+SSIM_K1 = 0.01
+SSIM_K2 = 0.03
+SSIM_TRUNCATE = 3.5
+SSIM_UNIFORM_WIN = 7
+
+# Approximate number of float64 slab-sized arrays alive in the streaming path
+N_SLAB_ARRAYS = 20
+# Maximum slices per slab (without halo) of the in-memory SSIM
+SSIM_SLAB_SIZE = 32
+
+# Read slab [start, stop) along the given axis (after reorientation) of the
+# image (or array) reoriented with ornt
+def read_slab(img, ornt, start, stop, axis = 0):
+    in_ax = int(np.flatnonzero(ornt[:,0] == axis)[0])
+    n = img.shape[in_ax]
+    if ornt[in_ax,1] == -1:
+        start, stop = n - stop, n - start
+    slicer = [slice(None)] * len(img.shape)
+    slicer[in_ax] = slice(start, stop)
+    data = img.dataobj if hasattr(img, 'dataobj') else img
+    slab = np.asarray(data[tuple(slicer)], dtype=np.float64)
+    return nib.orientations.apply_orientation(slab, ornt)
+
+# Maximum of the reference within the mask (as MaskIndex.max), reading the
+# uncompressed NIfTI files sequentially in chunks
+def nifti_data_range(ref_fpath, mask_fpath = None, chunk_size = 2**22):
+    def chunks(fpath):
+        img = nib.load(fpath)
+        slope, inter = img.header.get_slope_inter()
+        data = np.memmap(
+            fpath, dtype = img.header.get_data_dtype(), mode = 'r',
+            offset = int(img.dataobj.offset), shape = (int(np.prod(img.shape)),),
+        )
+        for start in range(0, data.size, chunk_size):
+            chunk = np.asarray(data[start:start + chunk_size], dtype=np.float64)
+            if slope is not None:
+                chunk = chunk * slope + (inter or 0.)
+            yield chunk
+
+    if mask_fpath and nib.load(mask_fpath).shape != nib.load(ref_fpath).shape:
+        raise ValueError('Mask and image have different dimensions.')
+    vmax, full = -np.inf, True
+    masks = chunks(mask_fpath) if mask_fpath else None
+    for ref in chunks(ref_fpath):
+        if masks is not None:
+            mask = next(masks)
+            inside = mask != 0
+            full = full and bool(np.all(inside))
+            ref = ref[inside] * mask[inside]
+        if ref.size:
+            vmax = max(vmax, float(np.max(ref)))
+    return vmax if full else max(vmax, 0.)
+
+def ssim_filter(gaussian_weights = True, sigma = 1.5):
+    if gaussian_weights:
+        # As skimage.filters.gaussian, separable and in the dtype of x
+        filter_func = lambda x: gaussian_filter(x, sigma = sigma, truncate = SSIM_TRUNCATE, mode = 'reflect')
+        win_size = 2 * int(SSIM_TRUNCATE * sigma + 0.5) + 1
+    else:
+        filter_func = lambda x: uniform_filter(x, size = SSIM_UNIFORM_WIN)
+        win_size = SSIM_UNIFORM_WIN
+    return filter_func, win_size
+
+# Local mean and mean of squares, which can be computed once for a reference
+def ssim_moments(x, gaussian_weights = True, sigma = 1.5):
+    filter_func, _ = ssim_filter(gaussian_weights, sigma)
+    return filter_func(x), filter_func(x * x)
+
+# Local means, variances and covariance of the SSIM
+def ssim_terms(im1, im2, gaussian_weights = True, sigma = 1.5, use_sample_covariance = False, moments2 = None):
+    filter_func, win_size = ssim_filter(gaussian_weights, sigma)
+
+    NP = win_size ** im1.ndim
+    cov_norm = NP / (NP - 1) if use_sample_covariance else 1.0
+
+    ux = filter_func(im1)
+    uxx = filter_func(im1 * im1)
+    uy, uyy = moments2 if moments2 is not None else (filter_func(im2), filter_func(im2 * im2))
+    uxy = filter_func(im1 * im2)
+    vx = cov_norm * (uxx - ux * ux)
+    vy = cov_norm * (uyy - uy * uy)
+    vxy = cov_norm * (uxy - ux * uy)
+    return ux, uy, vx, vy, vxy
+
+# SSIM from its terms, with a data range (or one per voxel)
+def ssim_from_terms(terms, data_range):
+    ux, uy, vx, vy, vxy = terms
+    if np.ndim(data_range) == 0:
+        C1 = float(SSIM_K1 * data_range) ** 2
+        C2 = float(SSIM_K2 * data_range) ** 2
+    else:
+        C1 = (SSIM_K1 * np.asarray(data_range, dtype=np.float64)) ** 2
+        C2 = (SSIM_K2 * np.asarray(data_range, dtype=np.float64)) ** 2
+    A1, A2, B1, B2 = (
+        2 * ux * uy + C1,
+        2 * vxy + C2,
+        ux**2 + uy**2 + C1,
+        vx + vy + C2,
+    )
+    return (A1 * A2) / (B1 * B2)
+
+def ssim_map(im1, im2, data_range, gaussian_weights = True, sigma = 1.5, use_sample_covariance = False, moments2 = None):
+    terms = ssim_terms(
+        im1, im2, gaussian_weights = gaussian_weights, sigma = sigma,
+        use_sample_covariance = use_sample_covariance, moments2 = moments2,
+    )
+    return ssim_from_terms(terms, data_range)
+
+# CPUs this process may run on
+def available_cpus():
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+# Mean SSIM over the volume cropped by pad, and within each of crop_indices
+# (MaskIndex, or LabelIndex for one mean per label), without building the
+# full map: slabs along the first axis (plus the filter halo) are processed
+# by `workers` threads (default: available CPUs) in the given dtype and
+# reduced to sums.
+# moments2 are the ssim_moments of the whole im2, in dtype. index_ranges
+# optionally gives the data range used within each index (one per label
+# for a LabelIndex, None for data_range), as if its SSIM were computed alone.
+def ssim_sums(
+    im1, im2, data_range, pad, crop_indices = (),
+    gaussian_weights = True, sigma = 1.5, use_sample_covariance = False,
+    moments2 = None, dtype = np.float32, workers = None, index_ranges = None,
+):
+    index_ranges = index_ranges if index_ranges is not None else [None] * len(crop_indices)
+    shape = im2.shape
+    if tuple(im1.shape) != tuple(shape):
+        raise ValueError('Reference and image have different dimensions.')
+    halo = int(SSIM_TRUNCATE * sigma + 0.5) if gaussian_weights else SSIM_UNIFORM_WIN // 2
+    workers = workers or available_cpus()
+    n_slab = max(1, min(SSIM_SLAB_SIZE, -(-shape[0] // workers)))
+    crop_inner = tuple(slice(pad, n - pad) for n in shape[1:])
+
+    def slab_sums(a, b):
+        # Cropped part of the slab
+        ca, cb = max(a, pad), min(b, shape[0] - pad)
+        if ca >= cb:
+            return 0., [0.] * len(crop_indices)
+        ha, hb = max(ca - halo, 0), min(cb + halo, shape[0])
+        terms = ssim_terms(
+            np.asarray(im1[ha:hb], dtype=dtype), np.asarray(im2[ha:hb], dtype=dtype),
+            gaussian_weights = gaussian_weights,
+            sigma = sigma,
+            use_sample_covariance = use_sample_covariance,
+            moments2 = None if moments2 is None else tuple(m[ha:hb] for m in moments2),
+        )
+        terms = tuple(t[ca - ha:cb - ha] for t in terms)
+        str_sim = ssim_from_terms(terms, data_range)
+        ssim_sum = str_sim[(slice(None),) + crop_inner].sum(dtype=np.float64)
+
+        index_sums = []
+        for index, index_range in zip(crop_indices, index_ranges):
+            if index_range is None:
+                index_sums.append(index.slab_sum(str_sim, ca))
+                continue
+            # SSIM of the indexed voxels only, with their own data range
+            values = [index.slab_values(t, ca) for t in terms]
+            sl = values[0][1]
+            if np.ndim(index_range) > 0:
+                index_range = np.asarray(index_range)[index.codes[sl]]
+            index_sums.append(index.reduce(ssim_from_terms([v for v, _ in values], index_range), sl))
+        return ssim_sum, index_sums
+
+    slabs = [(a, min(a + n_slab, shape[0])) for a in range(0, shape[0], n_slab)]
+    with ThreadPoolExecutor(max_workers = workers) as pool:
+        sums = list(pool.map(lambda ab: slab_sums(*ab), slabs))
+
+    n_crop = np.prod([n - 2 * pad for n in shape])
+    ssim = sum(s[0] for s in sums)/n_crop
+    ssim_masks = [sum(s[1][k] for s in sums)/index.weight_sum for k, index in enumerate(crop_indices)]
+    return ssim, ssim_masks
+
+# PSNR and SSIM accumulated over slabs along the last axis (contiguous in
+# NIfTI files), so only a slab (plus the filter halo) of each volume is held
+# in memory. The data range of the reference (within mask) is computed in a
+# first pass over the reference unless ref_range is given.
+def streaming_psnr_ssim(
+    REF, IM, ornt, REFmask = None,
+    max_memory = 1024,
+    gaussian_weights = True, sigma = 1.5, use_sample_covariance = False,
+    ref_range = None,
+):
+    shape = REF.shape
+    if tuple(shape) != tuple(nib.orientations.apply_orientation(np.empty(IM.shape, dtype=bool), ornt).shape):
+        raise ValueError('Reference and image have different dimensions.')
+
+    identity = nib.orientations.io_orientation(np.eye(4))
+    ax = len(shape) - 1
+    along = lambda sl: (slice(None),) * ax + (sl,)
+    pad = (2 * int(3.5 * sigma + 0.5)) // 2
+    halo = int(SSIM_TRUNCATE * sigma + 0.5) if gaussian_weights else SSIM_UNIFORM_WIN // 2
+
+    slice_bytes = np.prod(shape[:-1]) * 8 * N_SLAB_ARRAYS
+    n_slab = int(max_memory * 2**20 // slice_bytes) - 2 * halo
+    if n_slab < 1:
+        raise ValueError('--max-memory is too small for a single slab.')
+    slabs = [(a, min(a + n_slab, shape[ax])) for a in range(0, shape[ax], n_slab)]
+
+    # Data range of the reference (within mask)
+    if ref_range is None:
+        ref_range = -np.inf
+        for a, b in slabs:
+            ref = read_slab(REF, identity, a, b, ax)
+            if REFmask is not None:
+                ref_range = max(ref_range, MaskIndex(read_slab(REFmask, identity, a, b, ax)).max(ref))
+            else:
+                ref_range = max(ref_range, np.max(ref))
+
+    sq_err_sum = sq_err_mask_sum = mask_sum = 0.
+    ssim_sum = ssim_mask_sum = crop_mask_sum = 0.
+    crop_inner = tuple(slice(pad, n - pad) for n in shape[:-1])
+    for a, b in slabs:
+        # Slab extended with the filter halo
+        ha, hb = max(a - halo, 0), min(b + halo, shape[ax])
+        ref = read_slab(REF, identity, ha, hb, ax)
+        im = read_slab(IM, ornt, ha, hb, ax)
+        core = along(slice(a - ha, b - ha))
+
+        sq_err = (ref[core] - im[core]) ** 2
+        sq_err_sum += np.sum(sq_err, dtype=np.float64)
+
+        str_sim = ssim_map(
+            im, ref, ref_range,
+            gaussian_weights = gaussian_weights,
+            sigma = sigma,
+            use_sample_covariance = use_sample_covariance,
+        )
+        del ref, im
+
+        # Cropped part of the slab core
+        ca, cb = max(a, pad), min(b, shape[ax] - pad)
+        crop_slab = crop_inner + (slice(ca - ha, cb - ha),) if ca < cb else None
+        if crop_slab is not None:
+            ssim_sum += str_sim[crop_slab].sum(dtype=np.float64)
+
+        if REFmask is not None:
+            mask = read_slab(REFmask, identity, ha, hb, ax)
+            core_index = MaskIndex(mask[core])
+            sq_err_mask_sum += core_index.sum(sq_err)
+            mask_sum += core_index.weight_sum
+            if crop_slab is not None:
+                crop_index = MaskIndex(mask[crop_slab])
+                ssim_mask_sum += crop_index.sum(str_sim[crop_slab])
+                crop_mask_sum += crop_index.weight_sum
+
+    n_vox = np.prod(shape)
+    n_crop = np.prod([n - 2 * pad for n in shape])
+    mse = sq_err_sum/n_vox
+    result = {
+        'PSNR': 10 * np.log10((ref_range ** 2) / mse),
+        'SSIM': ssim_sum/n_crop,
+    }
+    if REFmask is not None:
+        mse = sq_err_mask_sum/mask_sum
+        result['PSNR_mask'] = 10 * np.log10((ref_range ** 2) / mse)
+        result['SSIM_mask'] = ssim_mask_sum/crop_mask_sum
+    return result
 
 def main(args=None):
     
@@ -20,11 +290,17 @@ def main(args=None):
     parser.add_argument('--reference', type=str, required=True)
     parser.add_argument('--image', type=str, required=True)
     parser.add_argument('--reference-mask', type=str, default=None)
+    parser.add_argument('--labels', type=str, default=None, help='Label atlas in reference space. PSNR and SSIM are computed for each label.')
     parser.add_argument('--output-file', type=str, required=True)
     parser.add_argument('--no-reorient', action='store_true', default=False)
     parser.add_argument('--ssim-sigma', type=float, default=1.5)
     parser.add_argument('--ssim-non-gaussian-weights', action='store_true', default=False)
     parser.add_argument('--ssim-use-sample-covariance', action='store_true', default=False) 
+    parser.add_argument('--dtype', type=str, choices=['float32', 'float64'], default='float32', help='Precision of the SSIM filtering.')
+    parser.add_argument('--threads', type=int, default=None, help='Number of threads for the SSIM. Default: the available CPUs.')
+    parser.add_argument('--max-memory', type=float, default=None, help='Memory budget in MB. Process the volumes in slabs.')
+    parser.add_argument('--cache-dir', type=str, default=None, help='Directory to cache decoded volumes.')
+    parser.add_argument('--cache-max-gb', type=float, default=DEFAULT_CACHE_MAX_GB)
     
     args = parser.parse_args(args if args is not None else sys.argv[1:])
     
@@ -41,64 +317,82 @@ def main(args=None):
     if args.reference_mask and not os.path.isfile(args.reference_mask):
         raise ValueError('Reference mask image does not exist.')
         
-    # Read images
-    REF = nib.load(args.reference)
-    ref_range = np.max(REF.get_fdata())
-    
-    if args.reference_mask : 
-        REFmask = nib.load(args.reference_mask)
-        ref_range = np.max(REF.get_fdata()*REFmask.get_fdata())
-    
-    IM = nib.load(args.image)
-    
-    if not args.no_reorient:
-        im2ref_ornt = nib.orientations.ornt_transform(
-            start_ornt = nib.orientations.io_orientation(IM.affine),
-            end_ornt = nib.orientations.io_orientation(REF.affine)
-        )
-        IM = IM.as_reoriented(im2ref_ornt)
+    if args.labels and not os.path.isfile(args.labels):
+        raise ValueError('Label image does not exist.')
         
-    # Squared error map
-    sq_err = (REF.get_fdata() - IM.get_fdata()) ** 2
-    
-    # Structural similarity map
-    _, str_sim = structural_similarity(
-        IM.get_fdata(), REF.get_fdata(), 
-        data_range = ref_range,
+    if args.labels and (args.reference_mask or args.max_memory is not None):
+        raise ValueError('--labels cannot be used with --reference-mask or --max-memory.')
+        
+    if args.max_memory is not None:
+        return streaming_main(args)
+
+    # Same as evaluate_similarity.py with PSNR and SSIM only
+    from evaluate_similarity import evaluate_images #pylint: disable=import-outside-toplevel
+    result = evaluate_images(
+        args.reference,
+        [args.image],
+        mask_fpath = args.reference_mask,
+        labels_fpath = args.labels,
+        metrics = ['PSNR', 'SSIM'],
+        reorient = not args.no_reorient,
         gaussian_weights = not args.ssim_non_gaussian_weights,
         sigma = args.ssim_sigma,
         use_sample_covariance = args.ssim_use_sample_covariance,
-        full = True,
+        ssim_dtype = np.dtype(args.dtype),
+        ssim_threads = args.threads,
+        cache_dir = args.cache_dir,
+        cache_max_gb = args.cache_max_gb,
     )
-    pad = (2 * int(3.5 * args.ssim_sigma + 0.5)) // 2
     
-    # Calculate PSNR and SSIM for the whole image
-    mse =  np.sum(sq_err, dtype=np.float64)/sq_err.size
-    psnr_whole = 10 * np.log10((ref_range ** 2) / mse)
-    ssim_whole = crop(str_sim, pad).sum(dtype=np.float64)/crop(str_sim, pad).size
-    
-    # Calculate PSNR and SSIM within mask
-    if args.reference_mask :
-        mse = np.sum(sq_err*REFmask.get_fdata(), dtype=np.float64)/np.sum(REFmask.get_fdata())
-        psnr_mask = 10 * np.log10((ref_range ** 2) / mse)
-        ssim_mask = crop(str_sim*REFmask.get_fdata(), pad).sum(dtype=np.float64)/np.sum(crop(REFmask.get_fdata(), pad))
-        
-    # Construct dataframe with results
+    result.to_csv(args.output_file, index=False)
+    print("PSNR and SSIM saved in ", args.output_file)
+
+def streaming_main(args):
+    with tempfile.TemporaryDirectory(dir = scratch_dir()) as tmp_dir:
+        # Memmaps of the cached volumes, or proxies of the files read slab by
+        # slab (gzipped files are decompressed once to scratch)
+        ref_range = None
+        if args.cache_dir:
+            load = lambda fpath: load_volume(fpath, args.cache_dir, max_gb = args.cache_max_gb)
+        else:
+            fpaths = [args.reference, args.image] + ([args.reference_mask] if args.reference_mask else [])
+            with ThreadPoolExecutor(max_workers = len(fpaths)) as pool:
+                local = dict(zip(fpaths, pool.map(lambda fpath: uncompressed_input(fpath, tmp_dir), fpaths)))
+            with stage('data_range', image = args.reference):
+                ref_range = nifti_data_range(local[args.reference], local.get(args.reference_mask))
+            def load(fpath):
+                img = nib.load(local[fpath])
+                return img, img.affine
+        REF, ref_affine = load(args.reference)
+        IM, im_affine = load(args.image)
+        REFmask = load(args.reference_mask)[0] if args.reference_mask else None
+
+        if args.no_reorient:
+            ornt = nib.orientations.io_orientation(np.eye(4))
+        else:
+            ornt = nib.orientations.ornt_transform(
+                start_ornt = nib.orientations.io_orientation(im_affine),
+                end_ornt = nib.orientations.io_orientation(ref_affine)
+            )
+
+        with stage('ssim_streaming', image = args.image):
+            metrics = streaming_psnr_ssim(
+                REF, IM, ornt, REFmask = REFmask,
+                max_memory = args.max_memory,
+                gaussian_weights = not args.ssim_non_gaussian_weights,
+                sigma = args.ssim_sigma,
+                use_sample_covariance = args.ssim_use_sample_covariance,
+                ref_range = ref_range,
+            )
+        del REF, IM, REFmask
+
     result = pd.DataFrame(
         {
             'reference': [args.reference],
             'image': [args.image],
-            'PSNR': [psnr_whole],
-            'SSIM': [ssim_whole],
+            **{k: [v] for k, v in metrics.items()},
         }
     )
-    
-    if args.reference_mask:
-        result = result.assign(
-            PSNR_mask = [psnr_mask],
-            SSIM_mask = [ssim_mask]
-        )
-    
     result.to_csv(args.output_file, index=False)
     print("PSNR and SSIM saved in ", args.output_file)
         
@@ -2,35 +2,241 @@
 # Diana Giraldo
 
 import argparse
+import json
 import os, sys
+import tempfile
+import warnings
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
 import nibabel as nib
+from scipy import fft
 from scipy.ndimage import gaussian_filter
 
+from nifti_cache import DEFAULT_CACHE_MAX_GB, load_volume
+from nifti_output import save_nifti, scratch_dir, uncompressed_input
+from stage_trace import stage
+
 DEFAULT_FBA_P = 11
 DEFAULT_FBA_SIGMA = 5
+DEFAULT_CHUNK_SIZE = 16
 
-def fba_nd_onechannel(img_list, p = DEFAULT_FBA_P, sigma = DEFAULT_FBA_SIGMA):
-    
-    F_img = [np.fft.rfftn(img) for img in img_list]
-    W_img = [gaussian_filter(np.abs(fimg), sigma = sigma) ** p for fimg in F_img]
-    sum_W = np.sum(W_img, axis = 0)
-    U = np.sum([ fimg*(wimg/sum_W) for fimg, wimg in zip(F_img, W_img) ], axis = 0) 
+# Log of the FBA weight, p*log(G*|F|), computed in place on the magnitude
+def fba_log_weight(fimg, p, sigma, dtype):
+    logw = gaussian_filter(np.abs(fimg).astype(dtype, copy=False), sigma = sigma)
+    with np.errstate(divide='ignore'):
+        np.log(logw, out=logw)
+    logw *= p
+    return logw
+
+# Two passes over the inputs, accumulating in place so memory does not grow
+# with the number of images. Weights are normalised in log space (running
+# log-sum-exp) to avoid overflow of |F|**p. Items of img_list are passed
+# through loader (if given) so they can be read from disk in each pass.
+# With reuse_spectra, the spectra and weights of pass 1 are kept for pass 2
+# instead of being computed again (memory grows with the number of images).
+def fba_nd_onechannel(
+    img_list, p = DEFAULT_FBA_P, sigma = DEFAULT_FBA_SIGMA,
+    loader = None, dtype = np.float64, workers = None, reuse_spectra = False,
+):
+    load = loader if loader is not None else (lambda img: img)
+    dtype = np.dtype(dtype)
+
+    # Pass 1: log of sum of weights
+    max_logw = sum_w = None
+    spectra = []
+    for item in img_list:
+        img = np.asarray(load(item), dtype=dtype)
+        shape = img.shape
+        with stage('fft', fba_pass = 1):
+            fimg = fft.rfftn(img, workers=workers)
+            logw = fba_log_weight(fimg, p, sigma, dtype)
+        del img
+        # logw is not modified in place below
+        spectra.append((fimg, logw) if reuse_spectra else None)
+        del fimg
+        if max_logw is None:
+            max_logw = logw
+            sum_w = np.ones_like(logw)
+            continue
+        new_max = np.maximum(max_logw, logw)
+        with np.errstate(invalid='ignore'):
+            sum_w *= np.exp(max_logw - new_max)
+            sum_w += np.exp(logw - new_max)
+        max_logw = new_max
+        del logw
+    with np.errstate(divide='ignore'):
+        log_sum_w = max_logw + np.log(sum_w)
+    del max_logw, sum_w
+
+    # Pass 2: weighted spectrum
+    U = None
+    for k, item in enumerate(img_list):
+        if reuse_spectra:
+            fimg, w = spectra[k]
+            spectra[k] = None
+        else:
+            img = np.asarray(load(item), dtype=dtype)
+            with stage('fft', fba_pass = 2):
+                fimg = fft.rfftn(img, workers=workers)
+                del img
+                w = fba_log_weight(fimg, p, sigma, dtype)
+        w -= log_sum_w
+        np.exp(w, out=w)
+        fimg *= w
+        del w
+        if U is None:
+            U = fimg
+        else:
+            U += fimg
+        del fimg
     
-    return np.fft.irfftn(U)
+    with stage('fft', fba_pass = 'inverse'):
+        return fft.irfftn(U, s=shape, workers=workers)
+
+# FBA of 4D inputs, over the spatial axes only and independently for each
+# volume. frame_loader(item, t) reads volume t of an input. Volumes are
+# fused by `volume_workers` threads (each with `workers` FFT threads) and
+# written into out[..., t] as they finish, so memory scales with the
+# spectra of one volume per thread.
+def fba_4d(
+    img_list, out, frame_loader,
+    p = DEFAULT_FBA_P, sigma = DEFAULT_FBA_SIGMA,
+    dtype = np.float64, workers = None, volume_workers = None,
+):
+    def run(t):
+        with stage('fba_volume', volume = t):
+            out[..., t] = fba_nd_onechannel(
+                img_list, p = p, sigma = sigma,
+                loader = lambda item: frame_loader(item, t),
+                dtype = dtype, workers = workers, reuse_spectra = True,
+            )
+
+    with ThreadPoolExecutor(max_workers = volume_workers or 1) as pool:
+        list(pool.map(run, range(out.shape[-1])))
+    return out
+
+# Description of the inputs of a stack, saved next to it: resolved paths
+# (in order), shapes, modification times and sizes, and the stack dtype
+def stack_inputs(fpath_list, dtype):
+    inputs = []
+    for fpath in fpath_list:
+        st = os.stat(fpath)
+        inputs.append({
+            'path': os.path.realpath(fpath), 'shape': list(nib.load(fpath).shape),
+            'mtime_ns': st.st_mtime_ns, 'size': st.st_size,
+        })
+    return {'dtype': np.dtype(dtype).str, 'inputs': inputs}
+
+def stack_sidecar_path(stack_path):
+    return os.path.splitext(stack_path)[0] + '.json'
+
+# Write the inputs into one (N, X, Y, Z) .npy memmap, or reuse an existing
+# stack whose sidecar describes the same inputs
+def build_stack(fpath_list, stack_path, loader, dtype = np.float32):
+    sidecar_path = stack_sidecar_path(stack_path)
+    description = stack_inputs(fpath_list, dtype)
+    if os.path.isfile(stack_path) and os.path.isfile(sidecar_path):
+        with open(sidecar_path) as f:
+            try:
+                saved = json.load(f)
+            except ValueError:
+                saved = None
+        if saved == description:
+            stack = np.load(stack_path, mmap_mode='r')
+            shape = (len(fpath_list),) + tuple(description['inputs'][0]['shape'])
+            if stack.shape == shape and stack.dtype == np.dtype(dtype):
+                return stack
+            del stack
+
+    # The sidecar is written only once the stack is complete
+    if os.path.isfile(sidecar_path):
+        os.remove(sidecar_path)
+    stack = None
+    for i, fpath in enumerate(fpath_list):
+        img = loader(fpath)
+        if stack is None:
+            stack = np.lib.format.open_memmap(
+                stack_path, mode='w+', dtype=dtype, shape=(len(fpath_list),) + img.shape
+            )
+        elif img.shape != stack.shape[1:]:
+            raise ValueError(f'Input image {fpath} has a different shape.')
+        stack[i] = img
+        del img
+    stack.flush()
+    del stack
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(sidecar_path)), suffix='.tmp')
+    with os.fdopen(fd, 'w') as f:
+        json.dump(description, f)
+    os.replace(tmp_path, sidecar_path)
+    return np.load(stack_path, mmap_mode='r')
+
+def combine_stack_chunk(stack, sl, method = "average", fov_stack = None, nan_aware = False):
+    x = np.asarray(stack[..., sl], dtype=np.float64)
+
+    fov = None
+    if fov_stack is not None:
+        fov = np.asarray(fov_stack[..., sl], dtype=np.float64)
+    elif nan_aware:
+        fov = np.isfinite(x).astype(np.float64)
+
+    if fov is None:
+        return np.median(x, axis = 0) if method == "median" else np.mean(x, axis = 0)
+
+    # FOV-weighted, as the sum/divide of align_combine_mrtrix3.py
+    with warnings.catch_warnings(), np.errstate(invalid='ignore', divide='ignore'):
+        warnings.simplefilter('ignore', RuntimeWarning)
+        # Values outside the FOV are not combined
+        x[fov == 0] = np.nan
+        if method == "median":
+            out = np.nanmedian(x, axis = 0)
+        else:
+            out = np.nansum(x, axis = 0) / np.sum(fov, axis = 0)
+    out[~np.isfinite(out)] = 0
+    return out
+
+# Median/average along the image axis, in chunks along the last axis
+# (written into out if given, e.g. a memmap)
+def combine_stack(
+    stack, method = "average", fov_stack = None, nan_aware = False,
+    chunk_size = DEFAULT_CHUNK_SIZE, workers = None, out = None,
+):
+    if out is None:
+        out = np.empty(stack.shape[1:], dtype=np.float64)
+    nz = stack.shape[-1]
+    chunks = [slice(z, min(z + chunk_size, nz)) for z in range(0, nz, chunk_size)]
+
+    def run(sl):
+        out[..., sl] = combine_stack_chunk(stack, sl, method, fov_stack = fov_stack, nan_aware = nan_aware)
+
+    with ThreadPoolExecutor(max_workers = workers or 1) as pool:
+        list(pool.map(run, chunks))
+    return out
 
 # Select method to combine volumes
 def combine_images(
     img_list, 
     method = "average", 
     fba_p = DEFAULT_FBA_P, fba_sigma = DEFAULT_FBA_SIGMA,
+    loader = None, dtype = np.float64, workers = None,
 ):
     
     if method == "fba":
-        return fba_nd_onechannel(img_list, p = fba_p, sigma = fba_sigma)
+        # 4D arrays: each volume separately
+        if loader is None and np.ndim(img_list[0]) == 4:
+            return fba_4d(
+                img_list, np.empty(np.shape(img_list[0]), dtype=np.float64), lambda img, t: img[..., t],
+                p = fba_p, sigma = fba_sigma, dtype = dtype, workers = workers,
+            )
+        return fba_nd_onechannel(
+            img_list, p = fba_p, sigma = fba_sigma,
+            loader = loader, dtype = dtype, workers = workers,
+        )
+
+    if loader is not None:
+        img_list = [loader(item) for item in img_list]
 
-    elif method == "median":
+    if method == "median":
         return np.median(img_list, axis = 0)
     
     else:
@@ -47,6 +253,17 @@ def main(args=None):
     parser.add_argument('--method', type=str, choices=["fba", "median", "average"], default="average")
     parser.add_argument('--fba-p', type=int, default = DEFAULT_FBA_P)
     parser.add_argument('--fba-sigma', type=float, default = DEFAULT_FBA_SIGMA)
+    parser.add_argument('--fba-dtype', type=str, choices=["float64", "float32"], default="float64")
+    parser.add_argument('--workers', type=int, default=None, help='Number of threads for the FFTs and chunked median/average.')
+    parser.add_argument('--volume-workers', type=int, default=None, help='Number of volumes of 4D inputs fused at the same time with FBA.')
+    parser.add_argument('--stack', type=str, default=None, help='.npy file to store (or reuse) the stacked inputs for median/average. It is reused only if the inputs (paths, order, shapes and modification times) are the same.')
+    parser.add_argument('--fovs', nargs='+', type=str, default=None, help='FOV masks of the inputs, to average only within each FOV.')
+    parser.add_argument('--nan-aware', action='store_true', default=False, help='Ignore NaN voxels when combining.')
+    parser.add_argument('--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE)
+    parser.add_argument('--cache-dir', type=str, default=None, help='Directory to cache decoded volumes.')
+    parser.add_argument('--cache-max-gb', type=float, default=DEFAULT_CACHE_MAX_GB)
+    parser.add_argument('--dtype', type=str, choices=["float32", "float64", "input"], default="float32", help='Data type of the output image ("input": that of the first input, with scaling).')
+    parser.add_argument('--compress-level', type=int, default=None, help='gzip level of a .nii.gz output.')
     parser.add_argument('--verbose', action='store_true', default=False)
     
     args = parser.parse_args(args if args is not None else sys.argv[1:])
@@ -56,24 +273,89 @@ def main(args=None):
         if not os.path.isfile(in_file):
             raise ValueError(f'Input image file {in_file} does not exist.')
 
+    if args.fovs is not None:
+        if len(args.fovs) != len(args.inputs):
+            raise ValueError('Number of FOV masks and input images do not match.')
+        for fov_file in args.fovs:
+            if not os.path.isfile(fov_file):
+                raise ValueError(f'FOV mask file {fov_file} does not exist.')
+
     if args.verbose: 
         print(f'Loading {len(args.inputs)} input images')
         print(*args.inputs, sep = '\n')
     
     # Get first image
     img0 = nib.load(args.inputs[0])
-    img_list = [img0.get_fdata()]
+    if len(img0.shape) not in (3, 4):
+        raise ValueError('Input images must be 3D or 4D.')
+    for in_file in args.inputs[1:]:
+        if nib.load(in_file).shape != img0.shape:
+            raise ValueError(f'Input image {in_file} has a different shape.')
+
+    load = lambda fpath: np.asarray(
+        load_volume(fpath, args.cache_dir, max_gb = args.cache_max_gb)[0], dtype=np.float64
+    )
+
+    with tempfile.TemporaryDirectory(dir = scratch_dir()) as tmp_dir:
+        # One volume of a 4D input: a slice of the cached copy, or read from
+        # the file (gzipped inputs are decompressed once to scratch)
+        frame_images = {}
+        if len(img0.shape) == 4 and args.method == "fba" and not args.cache_dir:
+            with ThreadPoolExecutor(max_workers = args.workers or 1) as pool:
+                local = list(pool.map(lambda fpath: uncompressed_input(fpath, tmp_dir), args.inputs))
+            frame_images = {fpath: nib.load(local_fpath) for fpath, local_fpath in zip(args.inputs, local)}
+
+        def load_frame(fpath, t):
+            if args.cache_dir:
+                return np.asarray(load_volume(fpath, args.cache_dir, max_gb = args.cache_max_gb)[0][..., t], dtype=np.float64)
+            return np.asarray(frame_images[fpath].dataobj[..., t], dtype=np.float64)
 
-    # Get list of arrays
-    for i in range(1, len(args.inputs)):
-        img_list.append(nib.load(args.inputs[i]).get_fdata())
+        # 4D outputs are written volume by volume into a memmap
+        out = None
+        if len(img0.shape) == 4:
+            out = np.lib.format.open_memmap(
+                os.path.join(tmp_dir, 'out.npy'), mode='w+', fortran_order=True,
+                dtype = np.float64 if args.dtype == "input" else args.dtype, shape = img0.shape,
+            )
 
-    # Combine
-    out = combine_images(img_list, method = args.method, fba_p = args.fba_p, fba_sigma = args.fba_sigma)
+        # Combine (images are read from disk when needed)
+        if args.method == "fba" and out is not None:
+            fba_4d(
+                args.inputs, out, load_frame,
+                p = args.fba_p, sigma = args.fba_sigma,
+                dtype = args.fba_dtype, workers = args.workers, volume_workers = args.volume_workers,
+            )
+        elif args.method == "fba":
+            out = combine_images(
+                args.inputs, method = args.method,
+                fba_p = args.fba_p, fba_sigma = args.fba_sigma,
+                loader = load, dtype = args.fba_dtype, workers = args.workers,
+            )
+        else:
+            stack_path = args.stack or os.path.join(tmp_dir, 'stack.npy')
+            with stage('build_stack'):
+                stack = build_stack(args.inputs, stack_path, load)
+            fov_stack = None
+            if args.fovs is not None:
+                fov_path = os.path.splitext(stack_path)[0] + '_fov.npy'
+                fov_stack = build_stack(args.fovs, fov_path, load, dtype = bool)
+            with stage('combine', method = args.method):
+                out = combine_stack(
+                    stack, method = args.method,
+                    fov_stack = fov_stack, nan_aware = args.nan_aware,
+                    chunk_size = args.chunk_size, workers = args.workers, out = out,
+                )
+            del stack, fov_stack
 
-    # Save combined image
-    out_nib = nib.Nifti1Image(out, img0.affine, img0.header)
-    nib.save(out_nib, args.output)
+        # Save combined image
+        header = img0.header.copy()
+        if args.dtype != "input":
+            out = out.astype(args.dtype, copy=False)
+            header.set_data_dtype(args.dtype)
+            header.set_slope_inter(1, 0)
+        out_nib = nib.Nifti1Image(out, img0.affine, header)
+        save_nifti(out_nib, args.output, level = args.compress_level, threads = args.workers)
+        del out, out_nib
     if args.verbose: print("Output image saved in", args.output)
 
 #---------------------------------------------
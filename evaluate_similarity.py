@@ -0,0 +1,354 @@
+#!/usr/bin/env python3
+# PSNR, SSIM, MI, KL and NCC of images against one reference in one pass
+# The reference (with its mask index, SSIM local moments, MI bins and
+# centred samples) is prepared once. Each image is loaded and reoriented to
+# the reference once, and all metrics are computed from it. Images are
+# evaluated in parallel threads and the results saved as one wide CSV.
+# With a label atlas, the metrics of every label are reduced from the same
+# squared error and SSIM slabs (one row per image and label), each with the
+# data range and MI bins of that label, as with the label as mask.
+# Diana Giraldo
+
+import os, sys
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+import nibabel as nib
+
+from calculate_mi_kl_corr import (
+    N_BINS, pair_similarity, pair_similarity_labels, prepare_label_samples, prepare_samples,
+)
+from calculate_ssim_psnr import available_cpus, ssim_moments, ssim_sums
+from mask_index import LabelIndex, MaskIndex
+from nifti_cache import DEFAULT_CACHE_MAX_GB, load_volume
+from stage_trace import stage
+
+METRICS = ['PSNR', 'SSIM', 'MI', 'KL', 'NCC']
+# Column order of the results
+COLUMNS = ['reference', 'image', 'label', 'PSNR', 'SSIM', 'PSNR_mask', 'SSIM_mask', 'MI', 'KL1', 'KL2', 'NCC']
+
+# Everything the images are compared with, computed once
+def prepare_reference(
+    ref_fpath,
+    mask_fpath = None,
+    labels_fpath = None,
+    metrics = METRICS,
+    mi_bins = N_BINS,
+    mi_robust_max = False,
+    gaussian_weights = True,
+    sigma = 1.5,
+    ssim_dtype = np.float32,
+    cache_dir = None,
+    cache_max_gb = DEFAULT_CACHE_MAX_GB,
+):
+    load = lambda fpath: load_volume(fpath, cache_dir, max_gb = cache_max_gb)
+
+    ref, ref_affine = load(ref_fpath)
+    ref = np.asarray(ref, dtype=np.float64)
+    pad = (2 * int(3.5 * sigma + 0.5)) // 2
+    reference = {
+        'fpath': ref_fpath,
+        'array': ref,
+        'affine': ref_affine,
+        'pad': pad,
+        'mask_index': None,
+        'crop_index': None,
+        'data_range': np.max(ref),
+    }
+
+    # Masked voxels, within the whole image and the cropped SSIM map
+    if mask_fpath:
+        mask = load(mask_fpath)[0]
+        reference['mask_index'] = MaskIndex(mask)
+        reference['crop_index'] = MaskIndex(mask, border = pad)
+        del mask
+        reference['data_range'] = reference['mask_index'].max(ref)
+
+    # Labelled voxels, with the same label order in both indices
+    if labels_fpath:
+        labels = load(labels_fpath)[0]
+        reference['label_index'] = LabelIndex(labels)
+        reference['crop_labels'] = LabelIndex(labels, border = pad, label_ids = reference['label_index'].label_ids)
+        del labels
+        reference['label_ranges'] = reference['label_index'].max(ref)
+
+    if 'SSIM' in metrics:
+        with stage('ssim_moments', image = ref_fpath):
+            reference['moments'] = ssim_moments(
+                ref.astype(ssim_dtype, copy=False), gaussian_weights = gaussian_weights, sigma = sigma,
+            )
+
+    if {'MI', 'KL', 'NCC'} & set(metrics):
+        with stage('binning', image = ref_fpath):
+            reference['samples'] = binned_samples(
+                ref, reference.get('label_index', reference['mask_index']),
+                mi_bins = mi_bins, mi_robust_max = mi_robust_max,
+            )
+    return reference
+
+# prepare_samples of the masked voxels, or of each label
+def binned_samples(array, mask_index = None, mi_bins = N_BINS, mi_robust_max = False):
+    if isinstance(mask_index, LabelIndex):
+        return prepare_label_samples(
+            mask_index.gather_by_label(array, np.float64), mask_index.offsets,
+            mi_bins = mi_bins, mi_robust_max = mi_robust_max,
+        )
+    x = mask_index.gather(array, np.float64) if mask_index is not None else array.ravel()
+    return prepare_samples(x, mi_bins = mi_bins, mi_robust_max = mi_robust_max)
+
+def evaluate_image(
+    reference,
+    img_fpath,
+    metrics = METRICS,
+    reorient = True,
+    mi_bins = N_BINS,
+    mi_robust_max = False,
+    gaussian_weights = True,
+    sigma = 1.5,
+    use_sample_covariance = False,
+    ssim_dtype = np.float32,
+    ssim_threads = None,
+    cache_dir = None,
+    cache_max_gb = DEFAULT_CACHE_MAX_GB,
+):
+    ref = reference['array']
+    mask_index, crop_index = reference['mask_index'], reference['crop_index']
+    data_range = reference['data_range']
+
+    im, im_affine = load_volume(img_fpath, cache_dir, max_gb = cache_max_gb)
+    if reorient:
+        im2ref_ornt = nib.orientations.ornt_transform(
+            start_ornt = nib.orientations.io_orientation(im_affine),
+            end_ornt = nib.orientations.io_orientation(reference['affine'])
+        )
+        with stage('reorient', image = img_fpath):
+            im = nib.orientations.apply_orientation(im, im2ref_ornt)
+    im = np.asarray(im, dtype=np.float64)
+    if im.shape != ref.shape:
+        raise ValueError(f'Reference and image {img_fpath} have different dimensions.')
+
+    if 'label_index' in reference:
+        return evaluate_labels(
+            reference, img_fpath, im, metrics = metrics,
+            mi_bins = mi_bins, mi_robust_max = mi_robust_max,
+            gaussian_weights = gaussian_weights, sigma = sigma,
+            use_sample_covariance = use_sample_covariance,
+            ssim_dtype = ssim_dtype, ssim_threads = ssim_threads,
+        )
+
+    result = {'reference': reference['fpath'], 'image': img_fpath}
+
+    if 'PSNR' in metrics:
+        sq_err = (ref - im) ** 2
+        mse = np.sum(sq_err, dtype=np.float64)/sq_err.size
+        result['PSNR'] = 10 * np.log10((data_range ** 2) / mse)
+        if mask_index is not None:
+            mse = mask_index.sum(sq_err)/mask_index.weight_sum
+            result['PSNR_mask'] = 10 * np.log10((data_range ** 2) / mse)
+        del sq_err
+
+    if 'SSIM' in metrics:
+        with stage('ssim', image = img_fpath):
+            ssim, ssim_masks = ssim_sums(
+                im, ref, data_range, reference['pad'],
+                [crop_index] if crop_index is not None else [],
+                gaussian_weights = gaussian_weights,
+                sigma = sigma,
+                use_sample_covariance = use_sample_covariance,
+                moments2 = reference['moments'],
+                dtype = ssim_dtype,
+                workers = ssim_threads,
+            )
+        result['SSIM'] = ssim
+        if crop_index is not None:
+            result['SSIM_mask'] = ssim_masks[0]
+
+    if {'MI', 'KL', 'NCC'} & set(metrics):
+        with stage('binning', image = img_fpath):
+            img = binned_samples(im, mask_index, mi_bins = mi_bins, mi_robust_max = mi_robust_max)
+        mi, kl, ncc = pair_similarity(reference['samples'], img, mi_bins = mi_bins)
+        if 'MI' in metrics:
+            result['MI'] = mi
+        if 'KL' in metrics:
+            result['KL1'], result['KL2'] = kl
+        if 'NCC' in metrics:
+            result['NCC'] = ncc
+
+    return [result]
+
+# Metrics of every label, each reduced with one bincount over the labelled
+# voxels. PSNR and SSIM use the data range of the reference within each
+# label, and MI/KL the bins of each label, so every label gets the values
+# of an evaluation with that label as mask (PSNR_mask and SSIM_mask).
+def evaluate_labels(
+    reference,
+    img_fpath,
+    im,
+    metrics = METRICS,
+    mi_bins = N_BINS,
+    mi_robust_max = False,
+    gaussian_weights = True,
+    sigma = 1.5,
+    use_sample_covariance = False,
+    ssim_dtype = np.float32,
+    ssim_threads = None,
+):
+    ref = reference['array']
+    label_index = reference['label_index']
+    label_ranges = reference['label_ranges']
+    result = {}
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        if 'PSNR' in metrics:
+            mse = label_index.sum((ref - im) ** 2)/label_index.weight_sum
+            result['PSNR'] = 10 * np.log10((label_ranges ** 2) / mse)
+
+        if 'SSIM' in metrics:
+            with stage('ssim', image = img_fpath):
+                _, (result['SSIM'],) = ssim_sums(
+                    im, ref, reference['data_range'], reference['pad'], [reference['crop_labels']],
+                    gaussian_weights = gaussian_weights,
+                    sigma = sigma,
+                    use_sample_covariance = use_sample_covariance,
+                    moments2 = reference['moments'],
+                    dtype = ssim_dtype,
+                    workers = ssim_threads,
+                    index_ranges = [label_ranges],
+                )
+
+        if {'MI', 'KL', 'NCC'} & set(metrics):
+            with stage('binning', image = img_fpath):
+                img = binned_samples(im, label_index, mi_bins = mi_bins, mi_robust_max = mi_robust_max)
+            mi, kl, ncc = pair_similarity_labels(reference['samples'], img, mi_bins = mi_bins)
+            if 'MI' in metrics:
+                result['MI'] = mi
+            if 'KL' in metrics:
+                result['KL1'] = [k[0] for k in kl]
+                result['KL2'] = [k[1] for k in kl]
+            if 'NCC' in metrics:
+                result['NCC'] = ncc
+
+    label_ids = [int(l) if float(l).is_integer() else l for l in label_index.label_ids]
+    return [
+        {'reference': reference['fpath'], 'image': img_fpath, 'label': label, **{k: v[i] for k, v in result.items()}}
+        for i, label in enumerate(label_ids)
+    ]
+
+# One row per image (or image and label), images evaluated by `workers` threads
+def evaluate_images(
+    ref_fpath,
+    img_fpath_list,
+    mask_fpath = None,
+    labels_fpath = None,
+    metrics = METRICS,
+    reorient = True,
+    mi_bins = N_BINS,
+    mi_robust_max = False,
+    gaussian_weights = True,
+    sigma = 1.5,
+    use_sample_covariance = False,
+    ssim_dtype = np.float32,
+    ssim_threads = None,
+    workers = None,
+    cache_dir = None,
+    cache_max_gb = DEFAULT_CACHE_MAX_GB,
+):
+    # The available CPUs are shared by the images evaluated at the same time
+    ssim_threads = ssim_threads or max(1, available_cpus() // (workers or 1))
+    reference = prepare_reference(
+        ref_fpath, mask_fpath, labels_fpath, metrics = metrics,
+        mi_bins = mi_bins, mi_robust_max = mi_robust_max,
+        gaussian_weights = gaussian_weights, sigma = sigma, ssim_dtype = ssim_dtype,
+        cache_dir = cache_dir, cache_max_gb = cache_max_gb,
+    )
+
+    def evaluate(img_fpath):
+        return evaluate_image(
+            reference, img_fpath, metrics = metrics, reorient = reorient,
+            mi_bins = mi_bins, mi_robust_max = mi_robust_max,
+            gaussian_weights = gaussian_weights, sigma = sigma,
+            use_sample_covariance = use_sample_covariance,
+            ssim_dtype = ssim_dtype, ssim_threads = ssim_threads,
+            cache_dir = cache_dir, cache_max_gb = cache_max_gb,
+        )
+
+    with ThreadPoolExecutor(max_workers = workers or 1) as pool:
+        rows = [row for img_rows in pool.map(evaluate, img_fpath_list) for row in img_rows]
+    result = pd.DataFrame(rows)
+    return result[[c for c in COLUMNS if c in result.columns]]
+
+#---------------------------------------------
+
+def main(args=None):
+
+    # Get inputs
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-r', '--reference', type=str, required=True)
+    parser.add_argument('-i', '--images', nargs='+', required=True)
+    parser.add_argument('-o', '--output-file', type=str, required=True)
+    parser.add_argument('-m', '--reference-mask', type=str, default=None)
+    parser.add_argument('-l', '--labels', type=str, default=None, help='Label atlas in reference space. Metrics are computed for each label.')
+    parser.add_argument('--metrics', nargs='+', choices=METRICS, default=METRICS)
+    parser.add_argument('--no-reorient', action='store_true', default=False)
+    parser.add_argument('--n-bins', type=int, default=N_BINS)
+    parser.add_argument('--robust-max', action='store_true', default=False)
+    parser.add_argument('--ssim-sigma', type=float, default=1.5)
+    parser.add_argument('--ssim-non-gaussian-weights', action='store_true', default=False)
+    parser.add_argument('--ssim-use-sample-covariance', action='store_true', default=False)
+    parser.add_argument('--ssim-dtype', type=str, choices=['float32', 'float64'], default='float32')
+    parser.add_argument('--ssim-threads', type=int, default=None, help='Number of threads for the SSIM of each image. Default: the available CPUs divided by --workers.')
+    parser.add_argument('--workers', type=int, default=None, help='Number of images evaluated at the same time.')
+    parser.add_argument('--cache-dir', type=str, default=None, help='Directory to cache decoded volumes.')
+    parser.add_argument('--cache-max-gb', type=float, default=DEFAULT_CACHE_MAX_GB)
+
+    args = parser.parse_args(args if args is not None else sys.argv[1:])
+
+    # Check inputs
+    if not os.path.isfile(args.reference):
+        raise ValueError('Input reference does not exist.')
+
+    for img_fpath in args.images:
+        if not os.path.isfile(img_fpath):
+            raise ValueError(f'Input image {img_fpath} does not exist.')
+
+    if not os.path.isdir(os.path.dirname(os.path.abspath(args.output_file))):
+        raise ValueError('Output directory does not exist.')
+
+    if args.reference_mask and not os.path.isfile(args.reference_mask):
+        raise ValueError('Reference mask image does not exist.')
+
+    if args.labels and not os.path.isfile(args.labels):
+        raise ValueError('Label image does not exist.')
+
+    if args.labels and args.reference_mask:
+        raise ValueError('Use either a reference mask or labels.')
+
+    result = evaluate_images(
+        args.reference,
+        args.images,
+        mask_fpath = args.reference_mask,
+        labels_fpath = args.labels,
+        metrics = args.metrics,
+        reorient = not args.no_reorient,
+        mi_bins = args.n_bins,
+        mi_robust_max = args.robust_max,
+        gaussian_weights = not args.ssim_non_gaussian_weights,
+        sigma = args.ssim_sigma,
+        use_sample_covariance = args.ssim_use_sample_covariance,
+        ssim_dtype = np.dtype(args.ssim_dtype),
+        ssim_threads = args.ssim_threads,
+        workers = args.workers,
+        cache_dir = args.cache_dir,
+        cache_max_gb = args.cache_max_gb,
+    )
+
+    # Save
+    result.to_csv(args.output_file, index=False)
+    print("Results saved in ", args.output_file)
+
+#---------------------------------------------
+if __name__ == '__main__':
+    main()
@@ -4,36 +4,95 @@
 # Nov 2023
 
 import argparse
+import glob
+import gzip
 import os, sys
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
+import pandas as pd
 import nibabel as nib
 
+from stage_trace import stage
+
+def orientation_label(affine):
+    ori = nib.orientations.io_orientation(affine)[:,0].astype(np.int32)
+    if np.array_equal(ori, [0, 1, 2]):
+        return "TRA"
+    elif np.array_equal(ori, [1, 2, 0]):
+        return "SAG"
+    elif np.array_equal(ori, [0, 2, 1]):
+        return "COR"
+    return None
+
+# Read only the NIfTI header (the first bytes of the gzip stream for .nii.gz)
+def read_header(fpath):
+    opener = gzip.open if fpath.endswith('.gz') else open
+    with opener(fpath, 'rb') as f:
+        sizeof_hdr = f.read(4)
+        f.seek(0)
+        if 540 in (int.from_bytes(sizeof_hdr, 'little'), int.from_bytes(sizeof_hdr, 'big')):
+            return nib.Nifti2Header.from_fileobj(f)
+        return nib.Nifti1Header.from_fileobj(f)
+
+def header_orientation(fpath):
+    try:
+        hdr = read_header(fpath)
+    except Exception as e:
+        return {'file': fpath, 'error': str(e)}
+    affine = hdr.get_best_affine()
+    return {
+        'file': fpath,
+        'orientation': orientation_label(affine),
+        'axcodes': ''.join(nib.aff2axcodes(affine)),
+        'shape': 'x'.join(str(n) for n in hdr.get_data_shape()),
+        'zooms': 'x'.join(f'{z:g}' for z in hdr.get_zooms()),
+        'error': None,
+    }
+
+# Files matching the patterns (NIfTI files under directories)
+def find_files(patterns):
+    fpaths = []
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            pattern = os.path.join(pattern, '**', '*.nii*')
+        fpaths += [f for f in glob.glob(pattern, recursive=True) if f.endswith(('.nii', '.nii.gz'))]
+    return sorted(set(fpaths))
+
+def survey_orientation(fpaths, workers = None):
+    with ThreadPoolExecutor(max_workers = workers) as pool:
+        rows = list(pool.map(header_orientation, fpaths))
+    return pd.DataFrame(rows, columns = ['file', 'orientation', 'axcodes', 'shape', 'zooms', 'error'])
+
 def main(args=None):
-    
+
     # Get inputs
     parser = argparse.ArgumentParser()
-    parser.add_argument('--input', type=str, required=True)
-    
+    inputs = parser.add_mutually_exclusive_group(required=True)
+    inputs.add_argument('--input', type=str)
+    inputs.add_argument('--scan', nargs='+', type=str, help='Directories or glob patterns of NIfTI files. Only headers are read.')
+    parser.add_argument('--output', type=str, default=None, help='CSV file for --scan results (default: stdout).')
+    parser.add_argument('--workers', type=int, default=None)
+
     args = parser.parse_args(args if args is not None else sys.argv[1:])
-    
+
+    if args.scan is not None:
+        with stage('orientation_survey'):
+            result = survey_orientation(find_files(args.scan), workers = args.workers)
+        result.to_csv(args.output if args.output else sys.stdout, index=False)
+        return
+
     # Check arguments
     if not os.path.isfile(args.input):
         raise ValueError('Input image file does not exist.')
-    
+
     # Get input image orientation
     IM = nib.load(args.input)
-    im_ori = nib.orientations.io_orientation(IM.affine)
     #print(nib.aff2axcodes(IM.affine))
-    ori = im_ori[:,0].astype(np.int32)
-    #print(ori)
-    if np.array_equal(ori, [0, 1, 2]):
-        print("TRA")
-    elif np.array_equal(ori, [1, 2, 0]):
-        print("SAG")
-    elif np.array_equal(ori, [0, 2, 1]):
-       print("COR")
+    label = orientation_label(IM.affine)
+    if label is not None:
+        print(label)
 
 #---------------------------------------------
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+# Brain extraction of many images with a single HD-BET run
+# The images are linked into one folder and HD-BET is called once in folder
+# mode, so the network is loaded once for all of them. Only the masks are
+# kept, moved to the path each image asks for. BetBatcher collects the
+# images submitted by concurrent threads into such batches.
+# Diana Giraldo
+
+import argparse
+import contextlib
+import os, sys
+import shutil
+import subprocess
+import tempfile
+import threading
+
+from nifti_output import gzip_file
+from stage_trace import run, stage
+
+HDBET_OPTIONS = ['-device', 'cpu', '-mode', 'fast', '-tta', '0']
+# Seconds a batch waits for more images
+DEFAULT_WAIT = 5
+
+# Run HD-BET once for all inputs and move each mask to its path. HD-BET
+# only reads .nii.gz files in folder mode, so .nii inputs are gzipped (at
+# the fastest level) into the batch folder. Raises RuntimeError if HD-BET
+# fails, and returns whether each mask was produced.
+def run_hdbet_batch(inputs, masks, options = HDBET_OPTIONS, env = None):
+    if len(inputs) != len(masks):
+        raise ValueError('Number of inputs and masks differ.')
+    for fpath in inputs:
+        if not fpath.endswith(('.nii', '.nii.gz')):
+            raise ValueError(f'HD-BET input {fpath} is not a NIfTI file.')
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        in_dir, out_dir = os.path.join(tmp_dir, 'in'), os.path.join(tmp_dir, 'out')
+        os.makedirs(in_dir)
+        os.makedirs(out_dir)
+        for i, fpath in enumerate(inputs):
+            if fpath.endswith('.nii'):
+                gzip_file(fpath, os.path.join(in_dir, f'img{i}.nii.gz'), level = 1)
+            else:
+                os.symlink(os.path.abspath(fpath), os.path.join(in_dir, f'img{i}.nii.gz'))
+
+        with stage('hd-bet', n_images = len(inputs)):
+            status = run(
+                ['hd-bet', '-i', in_dir, '-o', out_dir] + list(options),
+                env = env, stdout = subprocess.DEVNULL,
+            )
+        if status != 0:
+            raise RuntimeError(f'HD-BET exited with status {status} for: ' + ', '.join(inputs))
+
+        ok = []
+        for i, mask in enumerate(masks):
+            src = os.path.join(out_dir, f'img{i}_mask.nii.gz')
+            ok.append(os.path.isfile(src))
+            if ok[-1]:
+                shutil.move(src, mask)
+    return ok
+
+# Images submitted by several threads are run together: the first thread of
+# a batch waits until batch_size images are pending (or `wait` seconds
+# pass), runs run_batch(inputs, masks) and wakes up the others. Threads that
+# may submit images can register with `with batcher.producer():`, and the
+# batch then also runs as soon as all registered threads are waiting in it.
+class BetBatcher:
+    def __init__(self, run_batch = run_hdbet_batch, batch_size = 8, wait = DEFAULT_WAIT):
+        self.run_batch = run_batch
+        self.batch_size = batch_size
+        self.wait = wait
+        self.pending = []
+        self.leading = False
+        self.producers = None
+        self.cond = threading.Condition()
+
+    @contextlib.contextmanager
+    def producer(self):
+        with self.cond:
+            self.producers = (self.producers or 0) + 1
+        try:
+            yield self
+        finally:
+            with self.cond:
+                self.producers -= 1
+                self.cond.notify_all()
+
+    def full(self):
+        n = len(self.pending)
+        return n >= self.batch_size or (self.producers is not None and n >= self.producers)
+
+    def submit(self, input_fpath, mask_fpath):
+        item = {'input': input_fpath, 'mask': mask_fpath, 'ok': False, 'done': threading.Event()}
+        with self.cond:
+            self.pending.append(item)
+            self.cond.notify_all()
+            leader = not self.leading
+            if leader:
+                self.leading = True
+                self.cond.wait_for(self.full, timeout = self.wait)
+                batch, self.pending = self.pending, []
+                self.leading = False
+
+        if leader:
+            try:
+                ok = self.run_batch([b['input'] for b in batch], [b['mask'] for b in batch])
+            except Exception as e: #pylint: disable=broad-except
+                print(e, file=sys.stderr)
+                ok = [False] * len(batch)
+            for b, o in zip(batch, ok):
+                b['ok'] = o
+                b['done'].set()
+        else:
+            item['done'].wait()
+        return item['ok']
+
+#---------------------------------------------
+
+def main(args=None):
+
+    # Get inputs
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-i', '--inputs', nargs='+', required=True)
+    parser.add_argument('-m', '--masks', nargs='+', required=True, help='Output mask of each input.')
+    parser.add_argument('--device', type=str, default='cpu')
+    parser.add_argument('--mode', type=str, choices=['fast', 'accurate'], default='fast')
+    parser.add_argument('--tta', type=int, choices=[0, 1], default=0)
+
+    args = parser.parse_args(args if args is not None else sys.argv[1:])
+
+    # Check inputs
+    if len(args.inputs) != len(args.masks):
+        raise ValueError('Number of inputs and masks differ.')
+
+    for fpath in args.inputs:
+        if not os.path.isfile(fpath):
+            raise ValueError(f'Input image {fpath} does not exist.')
+
+    ok = run_hdbet_batch(
+        args.inputs, args.masks,
+        options = ['-device', args.device, '-mode', args.mode, '-tta', str(args.tta)],
+    )
+    for fpath, o in zip(args.inputs, ok):
+        if not o:
+            print(f'HD-BET failed for {fpath}', file=sys.stderr)
+    print(f'{sum(ok)} of {len(ok)} masks saved')
+    if not all(ok):
+        sys.exit(1)
+
+#---------------------------------------------
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,112 @@
+# Compact voxel index of a mask
+# The mask is converted once to the flat indices of its voxels (plus their
+# values, for non-binary masks), so every image and metric gathers only the
+# masked voxels into a contiguous vector instead of boolean indexing or
+# multiplying full volumes.
+# Diana Giraldo
+
+import numpy as np
+
+class MaskIndex:
+    # border: leave out voxels closer than border to the volume edges
+    # (as skimage.util.crop), e.g. for SSIM maps
+    def __init__(self, mask, border = 0):
+        mask = np.asarray(mask)
+        self.shape = mask.shape
+        inside = mask != 0
+        for ax, n in enumerate(self.shape):
+            for s in [slice(0, border), slice(max(n - border, border), n)]:
+                inside[(slice(None),) * ax + (s,)] = False
+
+        # C-order flat indices, F-order ones are computed when needed
+        self.index = np.flatnonzero(inside)
+        self.index_f = None
+        values = np.take(mask, self.index)
+        self.weights = values.astype(np.float64) if np.any(values != 1) else None
+        self.weight_sum = np.sum(self.weights) if self.weights is not None else float(self.index.size)
+        self.full = self.index.size == inside.size
+
+    # Flat view of array and the indices of the mask in it
+    def flat_index(self, array):
+        if tuple(array.shape) != tuple(self.shape):
+            raise ValueError('Mask and image have different dimensions.')
+        if array.flags.c_contiguous:
+            return array.reshape(-1), self.index
+        if array.flags.f_contiguous:
+            if self.index_f is None:
+                self.index_f = np.ravel_multi_index(np.unravel_index(self.index, self.shape), self.shape, order='F')
+            return array.reshape(-1, order='F'), self.index_f
+        return np.ascontiguousarray(array).reshape(-1), self.index
+
+    # Masked voxels of array (in C order), as a contiguous vector
+    def gather(self, array, dtype = np.float32):
+        flat, index = self.flat_index(array)
+        return np.take(flat, index).astype(dtype, copy=False)
+
+    # Sum of values*mask, for values gathered at index[sl]
+    def reduce(self, values, sl = slice(None)):
+        return np.sum(values) if self.weights is None else np.dot(values, self.weights[sl])
+
+    # Sum of array*mask
+    def sum(self, array):
+        return self.reduce(self.gather(array, np.float64))
+
+    # Masked voxels of a slab of the volume starting at index start along the
+    # first axis, and the range of the index they correspond to
+    def slab_values(self, slab, start):
+        plane = int(np.prod(self.shape[1:]))
+        if tuple(slab.shape[1:]) != tuple(self.shape[1:]):
+            raise ValueError('Mask and slab have different dimensions.')
+        lo = start * plane
+        i0, i1 = np.searchsorted(self.index, [lo, lo + slab.size])
+        values = np.take(np.ascontiguousarray(slab).reshape(-1), self.index[i0:i1] - lo).astype(np.float64)
+        return values, slice(i0, i1)
+
+    # Sum of slab*mask
+    def slab_sum(self, slab, start):
+        values, sl = self.slab_values(slab, start)
+        return self.reduce(values, sl)
+
+    # Maximum of array*mask (zero outside the mask)
+    def max(self, array):
+        values = self.gather(array, np.float64)
+        if self.weights is not None:
+            values *= self.weights
+        vmax = np.max(values) if values.size else -np.inf
+        return vmax if self.full else max(vmax, 0.)
+
+# Compact index of a label atlas: the labelled voxels, as in MaskIndex, and
+# the position of their label in label_ids, so that per-label sums are a
+# single bincount. sum, slab_sum and max return one value per label, as
+# MaskIndex would for the mask of that label.
+class LabelIndex(MaskIndex):
+    def __init__(self, labels, border = 0, label_ids = None):
+        labels = np.asarray(labels)
+        if label_ids is None:
+            label_ids = labels[labels != 0]
+        self.label_ids = np.unique(label_ids)
+        super().__init__(np.isin(labels, self.label_ids), border = border)
+        self.codes = np.searchsorted(self.label_ids, np.take(labels, self.index))
+        self.weight_sum = self.bincount(None)
+        # Gathered voxels grouped by label (computed when needed): voxels of
+        # label k are order[offsets[k]:offsets[k+1]]
+        self.order = None
+        self.offsets = np.concatenate(([0], np.cumsum(self.weight_sum))).astype(np.intp)
+
+    def bincount(self, values, sl = slice(None)):
+        return np.bincount(self.codes[sl], weights = values, minlength = self.label_ids.size).astype(np.float64)
+
+    def reduce(self, values, sl = slice(None)):
+        return self.bincount(values, sl)
+
+    def max(self, array):
+        values = self.gather(array, np.float64)
+        vmax = np.full(self.label_ids.size, -np.inf)
+        np.maximum.at(vmax, self.codes, values)
+        return np.where(self.weight_sum == np.prod(self.shape), vmax, np.maximum(vmax, 0.))
+
+    # Labelled voxels of array grouped by label (see offsets)
+    def gather_by_label(self, array, dtype = np.float32):
+        if self.order is None:
+            self.order = np.argsort(self.codes, kind='stable')
+        return self.gather(array, dtype)[self.order]
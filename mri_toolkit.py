@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+# Long-running worker for the toolkit scripts
+# `serve` starts a worker listening on a Unix socket, with numpy, nibabel,
+# pandas and skimage already imported and recently loaded volumes kept in
+# memory. `run <job> ...` sends one job (same arguments as the script) and
+# prints its output.
+# Diana Giraldo
+
+import argparse
+import contextlib
+import importlib
+import io
+import json
+import os, sys
+import socket
+import socketserver
+import tempfile
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+
+# Job name -> script module
+JOBS = {
+    'ssim_psnr': 'calculate_ssim_psnr',
+    'mi_kl_corr': 'calculate_mi_kl_corr',
+    'orient': 'get_orient_nifti',
+    'reorient': 'reorient_nifti',
+    'reorient_ras': 'reorient_RAS',
+    'combine': 'combine_aligned_images',
+    'evaluate': 'evaluate_similarity',
+}
+
+DEFAULT_SOCKET = os.environ.get(
+    'MRI_TOOLKIT_SOCKET',
+    os.path.join(tempfile.gettempdir(), f'mri_toolkit-{os.getuid()}.sock')
+)
+DEFAULT_MEMORY_ITEMS = 8
+
+def init_worker(memory_items):
+    from nifti_cache import enable_memory_cache #pylint: disable=import-outside-toplevel
+    enable_memory_cache(memory_items)
+    for module in JOBS.values():
+        importlib.import_module(module)
+
+# Run a script's main() in a worker process, from the client's directory
+def run_job(job, args, cwd):
+    out, err = io.StringIO(), io.StringIO()
+    status = 0
+    os.chdir(cwd)
+    with contextlib.redirect_stdout(out), contextlib.redirect_stderr(err):
+        try:
+            importlib.import_module(JOBS[job]).main(args)
+        except SystemExit as e:
+            status = e.code if isinstance(e.code, int) else 1
+        except Exception:
+            traceback.print_exc()
+            status = 1
+    return {'status': status, 'stdout': out.getvalue(), 'stderr': err.getvalue()}
+
+class JobHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        request = json.loads(self.rfile.readline())
+        if request.get('job') not in JOBS:
+            response = {'status': 1, 'stdout': '', 'stderr': f"Unknown job {request.get('job')}.\n"}
+        else:
+            job = self.server.pool.submit(run_job, request['job'], request['args'], request['cwd'])
+            response = job.result()
+        self.wfile.write((json.dumps(response) + '\n').encode())
+
+def serve(socket_path, workers = None, memory_items = DEFAULT_MEMORY_ITEMS):
+    if os.path.exists(socket_path):
+        os.remove(socket_path)
+    with ProcessPoolExecutor(max_workers = workers, initializer = init_worker, initargs = (memory_items,)) as pool:
+        with socketserver.ThreadingUnixStreamServer(socket_path, JobHandler) as server:
+            server.pool = pool
+            print('Serving on', socket_path)
+            try:
+                server.serve_forever()
+            finally:
+                os.remove(socket_path)
+
+def submit(job, args, socket_path = DEFAULT_SOCKET):
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(socket_path)
+        request = {'job': job, 'args': args, 'cwd': os.getcwd()}
+        sock.sendall((json.dumps(request) + '\n').encode())
+        with sock.makefile('r') as f:
+            return json.loads(f.readline())
+
+#---------------------------------------------
+
+def main(args=None):
+
+    # Get inputs
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    serve_parser = subparsers.add_parser('serve')
+    serve_parser.add_argument('--socket', type=str, default=DEFAULT_SOCKET)
+    serve_parser.add_argument('--workers', type=int, default=None)
+    serve_parser.add_argument('--memory-items', type=int, default=DEFAULT_MEMORY_ITEMS, help='Number of volumes kept in memory by each worker.')
+
+    run_parser = subparsers.add_parser('run')
+    run_parser.add_argument('--socket', type=str, default=DEFAULT_SOCKET)
+    run_parser.add_argument('job', type=str, choices=sorted(JOBS))
+    run_parser.add_argument('job_args', nargs=argparse.REMAINDER)
+
+    args = parser.parse_args(args if args is not None else sys.argv[1:])
+
+    if args.command == 'serve':
+        serve(args.socket, workers = args.workers, memory_items = args.memory_items)
+        return
+
+    if not os.path.exists(args.socket):
+        raise ValueError(f'No worker listening on {args.socket}.')
+
+    response = submit(args.job, args.job_args, socket_path = args.socket)
+    sys.stdout.write(response['stdout'])
+    sys.stderr.write(response['stderr'])
+    if response['status']:
+        sys.exit(response['status'])
+
+#---------------------------------------------
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+# Absolute value of an uncompressed NIfTI image, in place
+# The data are memory-mapped and only negative voxels are rewritten, so an
+# intermediate image (e.g. the output of DenoiseImage) is not written
+# again to a second file.
+# From the shell: nifti_abs.py <image.nii>
+# Diana Giraldo
+
+import argparse
+import os, sys
+
+import numpy as np
+import nibabel as nib
+
+from stage_trace import stage
+
+# Voxels checked at a time
+CHUNK_SIZE = 2**22
+
+def abs_in_place(fpath, chunk_size = CHUNK_SIZE):
+    img = nib.load(fpath)
+    dtype = img.header.get_data_dtype()
+    slope, inter = img.header.get_slope_inter()
+    if fpath.endswith('.gz') or inter not in (None, 0) or (slope is not None and slope < 0):
+        raise ValueError('Only uncompressed images without offset or negative scaling are supported.')
+    if dtype.kind not in 'fi':
+        return 0
+
+    with stage('nifti_abs', file = fpath):
+        raw = np.memmap(
+            fpath, dtype = dtype, mode = 'r+',
+            offset = int(img.dataobj.offset), shape = (int(np.prod(img.shape)),),
+        )
+        n_neg = 0
+        for start in range(0, raw.size, chunk_size):
+            chunk = raw[start:start + chunk_size]
+            neg = chunk < 0
+            if neg.any():
+                chunk[neg] = -chunk[neg]
+                n_neg += int(np.count_nonzero(neg))
+        raw.flush()
+        del raw
+    return n_neg
+
+#---------------------------------------------
+
+def main(args=None):
+
+    # Get inputs
+    parser = argparse.ArgumentParser()
+    parser.add_argument('image', type=str, help='Uncompressed NIfTI image, modified in place.')
+
+    args = parser.parse_args(args if args is not None else sys.argv[1:])
+
+    # Check inputs
+    if not os.path.isfile(args.image):
+        raise ValueError('Input image does not exist.')
+
+    abs_in_place(args.image)
+
+#---------------------------------------------
+if __name__ == '__main__':
+    main()
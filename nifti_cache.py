@@ -0,0 +1,120 @@
+# On-disk cache of decoded NIfTI volumes
+# Decoded arrays are stored as uncompressed .npy files and opened with
+# mmap_mode, so repeated reads of the same .nii.gz skip the gzip decoding.
+# Entries are keyed by absolute path, modification time and size, and the
+# least recently used entries are removed when the cache exceeds its size.
+# Long-running processes can also keep the last loaded volumes in memory
+# (enable_memory_cache).
+
+import hashlib
+import os
+import tempfile
+from collections import OrderedDict
+
+import numpy as np
+import nibabel as nib
+
+from stage_trace import stage
+
+DEFAULT_CACHE_MAX_GB = 20
+
+# Volumes kept in memory, None when disabled
+MEMORY_CACHE = None
+MEMORY_CACHE_MAX_ITEMS = 0
+
+def enable_memory_cache(max_items = 8):
+    global MEMORY_CACHE, MEMORY_CACHE_MAX_ITEMS
+    MEMORY_CACHE = OrderedDict()
+    MEMORY_CACHE_MAX_ITEMS = max_items
+
+def cache_key(fpath, ras = False, dtype = np.float32):
+    st = os.stat(fpath)
+    key = '|'.join([
+        os.path.abspath(fpath), str(st.st_mtime_ns), str(st.st_size),
+        'ras' if ras else 'native', np.dtype(dtype).str,
+    ])
+    return hashlib.sha1(key.encode()).hexdigest()
+
+def evict(cache_dir, max_bytes):
+    entries = []
+    for fname in os.listdir(cache_dir):
+        if not fname.endswith('.npy') or fname.endswith('.affine.npy'):
+            continue
+        data_path = os.path.join(cache_dir, fname)
+        affine_path = data_path[:-len('.npy')] + '.affine.npy'
+        try:
+            st = os.stat(data_path)
+        except FileNotFoundError:
+            continue
+        entries.append((st.st_mtime, st.st_size, data_path, affine_path))
+
+    total = sum(e[1] for e in entries)
+    for _, size, data_path, affine_path in sorted(entries):
+        if total <= max_bytes:
+            break
+        for path in (data_path, affine_path):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        total -= size
+
+def save_atomic(path, array):
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+    with os.fdopen(fd, 'wb') as f:
+        np.save(f, array)
+    os.replace(tmp_path, path)
+
+def remember(key, data, affine):
+    data.flags.writeable = False
+    MEMORY_CACHE[key] = (data, affine)
+    while len(MEMORY_CACHE) > MEMORY_CACHE_MAX_ITEMS:
+        MEMORY_CACHE.popitem(last=False)
+    return data, affine
+
+def decode(fpath, ras = False):
+    with stage('nifti_load', file = fpath):
+        img = nib.load(fpath)
+        if ras:
+            img = nib.as_closest_canonical(img)
+        return img.get_fdata(), img.affine
+
+# Return (array, affine) of a NIfTI file, optionally reoriented to RAS.
+# Without cache_dir the array is get_fdata() (float64); with it, the array
+# is a read-only memmap of the cached copy stored as dtype.
+def load_volume(
+    fpath, cache_dir = None, ras = False, dtype = np.float32,
+    max_gb = DEFAULT_CACHE_MAX_GB,
+):
+    if MEMORY_CACHE is not None:
+        key = (cache_dir is None, cache_key(fpath, ras = ras, dtype = dtype))
+        if key in MEMORY_CACHE:
+            MEMORY_CACHE.move_to_end(key)
+            return MEMORY_CACHE[key]
+        return remember(key, *load_volume_uncached(fpath, cache_dir, ras, dtype, max_gb))
+    return load_volume_uncached(fpath, cache_dir, ras, dtype, max_gb)
+
+def load_volume_uncached(fpath, cache_dir, ras, dtype, max_gb):
+    if cache_dir is None:
+        return decode(fpath, ras = ras)
+
+    key = cache_key(fpath, ras = ras, dtype = dtype)
+    data_path = os.path.join(cache_dir, key + '.npy')
+    affine_path = os.path.join(cache_dir, key + '.affine.npy')
+
+    try:
+        data = np.load(data_path, mmap_mode='r')
+        affine = np.load(affine_path)
+        os.utime(data_path)
+        return data, affine
+    except (FileNotFoundError, ValueError):
+        pass
+
+    os.makedirs(cache_dir, exist_ok=True)
+    data, affine = decode(fpath, ras = ras)
+    save_atomic(affine_path, affine)
+    save_atomic(data_path, data.astype(dtype, copy=False))
+    del data
+    data = np.load(data_path, mmap_mode='r')
+    evict(cache_dir, max_gb * 2**30)
+    return data, affine
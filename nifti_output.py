@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+# Output policy of the toolkit
+# Intermediate images are written uncompressed (.nii). Only final outputs
+# are gzipped, with independent blocks compressed by several threads and
+# concatenated as gzip members (readable by nibabel, MRtrix3, ITK and
+# gzip). The level and number of threads default to MRI_TOOLKIT_GZIP_LEVEL
+# and MRI_TOOLKIT_GZIP_THREADS, and the uncompressed temporary file is
+# written to MRI_TOOLKIT_SCRATCH (e.g. /dev/shm) when it is set.
+# From the shell: nifti_output.py <input.nii> <output.nii.gz>
+# Diana Giraldo
+
+import argparse
+import gzip
+import os, sys
+import shutil
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+import nibabel as nib
+
+from stage_trace import stage
+
+LEVEL_ENV = 'MRI_TOOLKIT_GZIP_LEVEL'
+THREADS_ENV = 'MRI_TOOLKIT_GZIP_THREADS'
+SCRATCH_ENV = 'MRI_TOOLKIT_SCRATCH'
+
+# Same level as nibabel
+DEFAULT_LEVEL = 1
+# Bytes compressed by each thread at a time
+BLOCK_SIZE = 2**24
+
+def gzip_level(level = None):
+    return level if level is not None else int(os.environ.get(LEVEL_ENV, DEFAULT_LEVEL))
+
+def gzip_threads(threads = None):
+    return threads or int(os.environ.get(THREADS_ENV, 0)) or os.cpu_count() or 1
+
+def scratch_dir(default = None):
+    return os.environ.get(SCRATCH_ENV) or default
+
+# Compress src into dst (replaced atomically), block by block in parallel
+def gzip_file(src, dst, level = None, threads = None, block_size = BLOCK_SIZE):
+    level, threads = gzip_level(level), gzip_threads(threads)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(dst)), suffix='.tmp')
+    try:
+        with stage('gzip', file = dst), open(src, 'rb') as fin, os.fdopen(fd, 'wb') as fout, \
+                ThreadPoolExecutor(max_workers = threads) as pool:
+            # At most 2*threads blocks in memory
+            pending = []
+            while True:
+                block = fin.read(block_size)
+                if block:
+                    pending.append(pool.submit(gzip.compress, block, compresslevel = level))
+                if pending and (len(pending) >= 2 * threads or not block):
+                    fout.write(pending.pop(0).result())
+                if not block and not pending:
+                    break
+        os.replace(tmp_path, dst)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+# Uncompressed copy (in tmp_dir) of a gzipped input, so it can be read in
+# parts without decompressing the file again for each of them
+def uncompressed_input(fpath, tmp_dir):
+    if not fpath.endswith('.gz'):
+        return fpath
+    fd, out_path = tempfile.mkstemp(dir = tmp_dir, suffix = '.nii')
+    with stage('gunzip', file = fpath), gzip.open(fpath, 'rb') as fin, os.fdopen(fd, 'wb') as fout:
+        shutil.copyfileobj(fin, fout, 2**24)
+    return out_path
+
+# Save a NIfTI image: .nii directly, .nii.gz through a temporary .nii
+def save_nifti(img, fpath, level = None, threads = None):
+    if not fpath.endswith('.gz'):
+        with stage('nifti_save', file = fpath):
+            nib.save(img, fpath)
+        return
+    fd, tmp_path = tempfile.mkstemp(dir=scratch_dir(os.path.dirname(os.path.abspath(fpath))), suffix='.nii')
+    os.close(fd)
+    try:
+        with stage('nifti_save', file = tmp_path):
+            nib.save(img, tmp_path)
+        gzip_file(tmp_path, fpath, level = level, threads = threads)
+    finally:
+        os.remove(tmp_path)
+
+#---------------------------------------------
+
+def main(args=None):
+
+    # Get inputs
+    parser = argparse.ArgumentParser()
+    parser.add_argument('input', type=str, help='Uncompressed file.')
+    parser.add_argument('output', type=str, help='Compressed file.')
+    parser.add_argument('--level', type=int, default=None, help=f'Compression level. Default: ${LEVEL_ENV} or {DEFAULT_LEVEL}.')
+    parser.add_argument('--threads', type=int, default=None, help=f'Default: ${THREADS_ENV} or the number of CPUs.')
+    parser.add_argument('--keep', action='store_true', default=False, help='Keep the input file.')
+
+    args = parser.parse_args(args if args is not None else sys.argv[1:])
+
+    # Check inputs
+    if not os.path.isfile(args.input):
+        raise ValueError('Input file does not exist.')
+
+    gzip_file(args.input, args.output, level = args.level, threads = args.threads)
+    if not args.keep:
+        os.remove(args.input)
+
+#---------------------------------------------
+if __name__ == '__main__':
+    main()
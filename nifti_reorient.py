@@ -0,0 +1,65 @@
+# Reorientation that keeps the on-disk data type and scaling
+# Raw (unscaled) voxels are read slab by slab, flipped/transposed as views
+# and written in the same data type with the original slope/intercept, so
+# memory is bounded by the slab size and int16 data stays int16.
+# Diana Giraldo
+
+import numpy as np
+import nibabel as nib
+
+DEFAULT_MAX_MEMORY = 512
+
+# Header of the reoriented image, as nibabel's as_reoriented would give
+def reoriented_header(img, ornt, affine):
+    in_hdr = img.header
+    shape = nib.orientations.apply_orientation(np.broadcast_to(False, img.shape), ornt).shape
+    stub = np.broadcast_to(np.zeros((), dtype=in_hdr.get_data_dtype()), shape)
+    out = img.__class__(stub, affine, in_hdr)
+    out.update_header()
+    hdr = out.header
+    new_dim = [None if d is None else int(ornt[d, 0]) for d in in_hdr.get_dim_info()]
+    hdr.set_dim_info(*new_dim)
+    hdr.set_data_dtype(in_hdr.get_data_dtype())
+    hdr.set_slope_inter(img.dataobj.slope, img.dataobj.inter)
+    hdr['vox_offset'] = 0
+    return hdr
+
+# Write img reoriented with ornt (voxel axes) to out_fpath, slab by slab
+# along the last output axis (NIfTI data is stored first axis fastest)
+def save_reoriented(img, ornt, out_fpath, affine = None, max_memory = DEFAULT_MAX_MEMORY):
+    if affine is None:
+        affine = img.affine @ nib.orientations.inv_ornt_aff(ornt, img.shape)
+    hdr = reoriented_header(img, ornt, affine)
+    out_shape = hdr.get_data_shape()
+
+    # Unscaled view of the input voxels
+    in_dtype = img.header.get_data_dtype()
+    raw = nib.arrayproxy.ArrayProxy(
+        img.dataobj.file_like,
+        (img.shape, in_dtype, img.dataobj.offset, 1., 0.),
+    )
+
+    # Input axis (and flip) that becomes the last output axis
+    out_ax = len(out_shape) - 1
+    if out_ax < len(ornt):
+        in_ax = int(np.flatnonzero(ornt[:,0] == out_ax)[0])
+        flip = ornt[in_ax,1] == -1
+    else:
+        in_ax, flip = out_ax, False
+    n = out_shape[out_ax]
+
+    slice_bytes = int(np.prod(out_shape[:-1])) * in_dtype.itemsize
+    n_slab = max(1, int(max_memory * 2**20 // slice_bytes))
+
+    with nib.openers.Opener(out_fpath, 'wb') as f:
+        hdr.write_to(f)
+        f.write(b'\x00' * (int(hdr['vox_offset']) - f.tell()))
+        for start in range(0, n, n_slab):
+            stop = min(start + n_slab, n)
+            a, b = (n - stop, n - start) if flip else (start, stop)
+            slicer = [slice(None)] * len(img.shape)
+            slicer[in_ax] = slice(a, b)
+            slab = nib.orientations.apply_orientation(raw[tuple(slicer)], ornt)
+            f.write(slab.astype(in_dtype, copy=False).tobytes(order='F'))
+
+    return hdr
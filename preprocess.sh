@@ -12,10 +12,26 @@ RAW_IM=${1}
 OUT_DIR=${2}
 # ANTs directory (bin)
 ANTS_DIR=${3}
+# Stage to run: all (default), denoise, bet or n4
+STAGE=${4:-all}
 ############################################
 
 export ANTSPATH=${ANTS_DIR}
 
+# Record each step as a stage when MRI_TOOLKIT_TRACE is set
+SCR_DIR=${0:A:h}
+trace() {
+    if [[ -n ${MRI_TOOLKIT_TRACE} ]]; then
+        python3 ${SCR_DIR}/stage_trace.py "$@"
+    else
+        shift
+        "$@"
+    fi
+}
+
+# Intermediate images are uncompressed, the final image is gzipped in
+# parallel (MRI_TOOLKIT_GZIP_LEVEL, MRI_TOOLKIT_GZIP_THREADS)
+
 # Image basename
 IM_BN=$(basename ${RAW_IM} | sed 's/.nii.gz//')
 
@@ -23,22 +39,30 @@ IM_BN=$(basename ${RAW_IM} | sed 's/.nii.gz//')
 # Output directory
 mkdir -p ${OUT_DIR}
 
+if [[ ${STAGE} == all || ${STAGE} == denoise ]]; then
 # Denoise
-DenoiseImage -d 3 -n Rician -i ${RAW_IM} -o ${OUT_DIR}/${IM_BN}_dn.nii.gz
-# Calculate absolute value to remove negatives
-ImageMath 3 ${OUT_DIR}/${IM_BN}_dnabs.nii.gz abs ${OUT_DIR}/${IM_BN}_dn.nii.gz
-mv ${OUT_DIR}/${IM_BN}_dnabs.nii.gz ${OUT_DIR}/${IM_BN}_dn.nii.gz
+trace denoise DenoiseImage -d 3 -n Rician -i ${RAW_IM} -o ${OUT_DIR}/${IM_BN}_dn.nii
+# Calculate absolute value to remove negatives (in place)
+python3 ${SCR_DIR}/nifti_abs.py ${OUT_DIR}/${IM_BN}_dn.nii
+fi
 
+if [[ ${STAGE} == all || ${STAGE} == bet ]]; then
 # Brain Extraction with HD-BET
-hd-bet -i ${OUT_DIR}/${IM_BN}_dn.nii.gz -o ${OUT_DIR}/${IM_BN}_bet.nii.gz -device cpu -mode fast -tta 0 > /dev/null
+trace hd-bet hd-bet -i ${OUT_DIR}/${IM_BN}_dn.nii -o ${OUT_DIR}/${IM_BN}_bet.nii.gz -device cpu -mode fast -tta 0 > /dev/null
 rm ${OUT_DIR}/${IM_BN}_bet.nii.gz
 mv ${OUT_DIR}/${IM_BN}_bet_mask.nii.gz ${OUT_DIR}/${IM_BN}_brainmask.nii.gz
+fi
 
+if [[ ${STAGE} == all || ${STAGE} == n4 ]]; then
 # Biasfield correction N4
-N4BiasFieldCorrection -d 3 -i ${OUT_DIR}/${IM_BN}_dn.nii.gz -o ${OUT_DIR}/${IM_BN}_preproc.nii.gz -x ${OUT_DIR}/${IM_BN}_brainmask.nii.gz
+trace n4 N4BiasFieldCorrection -d 3 -i ${OUT_DIR}/${IM_BN}_dn.nii -o ${OUT_DIR}/${IM_BN}_preproc.nii -x ${OUT_DIR}/${IM_BN}_brainmask.nii.gz
+python3 ${SCR_DIR}/nifti_output.py ${OUT_DIR}/${IM_BN}_preproc.nii ${OUT_DIR}/${IM_BN}_preproc.nii.gz
+fi
 
+if [[ ${STAGE} == all ]]; then
 # Remove denoised image
-rm ${OUT_DIR}/${IM_BN}_dn.nii.gz
+rm ${OUT_DIR}/${IM_BN}_dn.nii
+fi
 
 ############################################
 # Output:
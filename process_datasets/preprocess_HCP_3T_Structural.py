@@ -0,0 +1,255 @@
+#!/usr/bin/env python3
+# Process HCP structural, many subjects in parallel
+# Extracts only the T1w_MPR/T2w_SP images from each .zip and runs the
+# denoise -> HD-BET -> N4 stages of preprocess.sh for every image, with a
+# bounded number of CPUs per stage. A manifest in the output directory
+# records finished stages, so reruns skip stages whose outputs are newer
+# than their inputs. HD-BET runs once for the images of concurrent jobs
+# that reach brain extraction together.
+# Diana Giraldo
+
+import argparse
+import fnmatch
+import json
+import os, sys
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+
+SCR_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+ANTS_DIR = '/opt/ANTs/bin'
+
+sys.path.insert(0, SCR_DIR)
+
+from hdbet_batch import DEFAULT_WAIT, BetBatcher, run_hdbet_batch #pylint: disable=wrong-import-position
+
+# Images to process from each zip (first match, as `ls | head -n 1`)
+MODALITIES = {
+    'T1': '*/unprocessed/3T/T1w_MPR*/*T1w_MPR*.nii.gz',
+    'T2': '*/unprocessed/3T/T2w_SP*/*T2w_SP*.nii.gz',
+}
+
+# Stages of preprocess.sh: inputs and outputs (relative to the image basename)
+STAGES = [
+    ('denoise', ['raw'], ['_dn.nii']),
+    ('bet', ['_dn.nii'], ['_brainmask.nii.gz']),
+    ('n4', ['_dn.nii', '_brainmask.nii.gz'], ['_preproc.nii.gz']),
+]
+# Outputs removed once the image is processed
+INTERMEDIATE = ['_dn.nii']
+DEFAULT_CPUS = {'denoise': 4, 'bet': 4, 'n4': 4}
+
+def stage_env(n):
+    env = dict(os.environ)
+    env['ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS'] = str(n)
+    env['OMP_NUM_THREADS'] = str(n)
+    env['MRI_TOOLKIT_GZIP_THREADS'] = str(n)
+    return env
+
+# Count of free CPUs shared by all running stages
+class CPUPool:
+    def __init__(self, n_cpus):
+        self.free = n_cpus
+        self.n_cpus = n_cpus
+        self.cond = threading.Condition()
+
+    def acquire(self, n):
+        n = min(n, self.n_cpus)
+        with self.cond:
+            self.cond.wait_for(lambda: self.free >= n)
+            self.free -= n
+        return n
+
+    def release(self, n):
+        with self.cond:
+            self.free += n
+            self.cond.notify_all()
+
+class Manifest:
+    def __init__(self, fpath):
+        self.fpath = fpath
+        self.lock = threading.Lock()
+        self.entries = {}
+        if os.path.isfile(fpath):
+            with open(fpath) as f:
+                self.entries = json.load(f)
+
+    def get(self, key):
+        with self.lock:
+            return dict(self.entries.get(key, {}))
+
+    def update(self, key, stage, record):
+        with self.lock:
+            self.entries.setdefault(key, {})[stage] = record
+            tmp_path = self.fpath + '.tmp'
+            with open(tmp_path, 'w') as f:
+                json.dump(self.entries, f, indent=1)
+            os.replace(tmp_path, self.fpath)
+
+def find_member(zip_fpath, pattern):
+    with zipfile.ZipFile(zip_fpath) as zf:
+        members = sorted(fnmatch.filter(zf.namelist(), pattern))
+    return members[0] if members else None
+
+def extract_member(zip_fpath, member, out_dir):
+    out_fpath = os.path.join(out_dir, os.path.basename(member))
+    with zipfile.ZipFile(zip_fpath) as zf, zf.open(member) as src, open(out_fpath, 'wb') as dst:
+        shutil.copyfileobj(src, dst, 2**24)
+    return out_fpath
+
+# Stages to run, walking back from the kept outputs as make does: a stage
+# runs if it is not up to date or an upstream stage runs, and a missing
+# intermediate input (the denoised image removed after N4) is only rebuilt
+# when a stage that needs it has to run
+def stages_to_run(im_bn, out_dir, source_mtime, done, intermediate = INTERMEDIATE):
+    def mtime(suffix):
+        if suffix == 'raw':
+            return source_mtime
+        fpath = os.path.join(out_dir, im_bn + suffix)
+        return os.path.getmtime(fpath) if os.path.isfile(fpath) else None
+
+    def up_to_date(stage, inputs, outputs):
+        if stage not in done:
+            return False
+        out_times = [mtime(s) for s in outputs]
+        in_times = [t for t in (mtime(s) for s in inputs) if t is not None]
+        return None not in out_times and min(out_times) >= max(in_times, default=0)
+
+    producer = {out: i for i, (_, _, outputs) in enumerate(STAGES) for out in outputs}
+    run = [False] * len(STAGES)
+
+    def visit(i, force):
+        upstream = [(s, producer[s]) for s in STAGES[i][1] if s in producer]
+        for s, j in upstream:
+            if mtime(s) is not None:
+                visit(j, False)
+        if force or run[i] or any(run[j] for _, j in upstream) or not up_to_date(*STAGES[i]):
+            run[i] = True
+            for s, j in upstream:
+                if mtime(s) is None:
+                    visit(j, True)
+
+    for i, (_, _, outputs) in enumerate(STAGES):
+        if any(s not in intermediate for s in outputs):
+            visit(i, False)
+    return [stage for stage, r in zip(STAGES, run) if r]
+
+def process_image(zip_fpath, modality, args, manifest, cpus, bet):
+    member = find_member(zip_fpath, MODALITIES[modality])
+    if member is None:
+        print(f'No {modality} image in {zip_fpath}', file=sys.stderr)
+        return False
+
+    im_bn = os.path.basename(member).replace('.nii.gz', '')
+    source = {'zip': os.path.abspath(zip_fpath), 'member': member}
+    done = {
+        stage: record for stage, record in manifest.get(im_bn).items()
+        if record.get('source') == source
+    }
+    pending = stages_to_run(
+        im_bn, args.output_dir, os.path.getmtime(zip_fpath), done,
+        intermediate = [] if args.keep_intermediate else INTERMEDIATE,
+    )
+    if not pending:
+        return True
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        raw = extract_member(zip_fpath, member, tmp_dir) if pending[0][0] == 'denoise' else None
+        for stage, _, _ in pending:
+            start = time.time()
+            if stage == 'bet':
+                # Batched with the images of other jobs
+                ok = bet.submit(
+                    os.path.join(args.output_dir, im_bn + '_dn.nii'),
+                    os.path.join(args.output_dir, im_bn + '_brainmask.nii.gz'),
+                )
+            else:
+                n = cpus.acquire(args.stage_cpus[stage])
+                try:
+                    proc = subprocess.run(
+                        [os.path.join(args.toolkit_dir, 'preprocess.sh'),
+                         raw or os.path.join(tmp_dir, im_bn + '.nii.gz'),
+                         args.output_dir, args.ants_dir, stage],
+                        env=stage_env(n), stdout=subprocess.DEVNULL,
+                    )
+                finally:
+                    cpus.release(n)
+                ok = proc.returncode == 0
+            if not ok:
+                print(f'Stage {stage} failed for {im_bn}', file=sys.stderr)
+                return False
+            manifest.update(im_bn, stage, {
+                'source': source, 'finished': time.time(), 'seconds': time.time() - start,
+            })
+
+    # Remove denoised image, as preprocess.sh does
+    if not args.keep_intermediate:
+        dn = os.path.join(args.output_dir, im_bn + '_dn.nii')
+        if os.path.isfile(dn):
+            os.remove(dn)
+    return True
+
+#---------------------------------------------
+
+def main(args=None):
+
+    # Get inputs
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--zips', nargs='+', type=str, required=True)
+    parser.add_argument('--output-dir', type=str, required=True)
+    parser.add_argument('--modalities', nargs='+', choices=sorted(MODALITIES), default=sorted(MODALITIES))
+    parser.add_argument('--toolkit-dir', type=str, default=SCR_DIR)
+    parser.add_argument('--ants-dir', type=str, default=ANTS_DIR)
+    parser.add_argument('--jobs', type=int, default=4, help='Number of images processed at the same time.')
+    parser.add_argument('--cpus', type=int, default=os.cpu_count(), help='Total number of CPUs used by running stages.')
+    for stage, n in DEFAULT_CPUS.items():
+        parser.add_argument(f'--{stage}-cpus', type=int, default=n)
+    parser.add_argument('--bet-batch', type=int, default=None, help='Maximum number of images per HD-BET run. Default: --jobs.')
+    parser.add_argument('--bet-wait', type=float, default=DEFAULT_WAIT, help='Seconds to wait for more images before running HD-BET (it also runs when all running jobs are waiting for it).')
+    parser.add_argument('--manifest', type=str, default=None, help='Default: <output-dir>/preprocess_manifest.json')
+    parser.add_argument('--keep-intermediate', action='store_true', default=False)
+
+    args = parser.parse_args(args if args is not None else sys.argv[1:])
+    args.stage_cpus = {stage: getattr(args, f'{stage}_cpus') for stage in DEFAULT_CPUS}
+
+    # Check arguments
+    for zip_fpath in args.zips:
+        if not os.path.isfile(zip_fpath):
+            raise ValueError(f'Input zip file {zip_fpath} does not exist.')
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    manifest = Manifest(args.manifest or os.path.join(args.output_dir, 'preprocess_manifest.json'))
+    cpus = CPUPool(args.cpus)
+
+    # One HD-BET run (and CPU quota) per batch of images
+    def run_bet(inputs, masks):
+        n = cpus.acquire(args.stage_cpus['bet'])
+        try:
+            return run_hdbet_batch(inputs, masks, env = stage_env(n))
+        finally:
+            cpus.release(n)
+    bet = BetBatcher(run_bet, batch_size = args.bet_batch or args.jobs, wait = args.bet_wait)
+
+    # Each running job may submit an image to the HD-BET batch
+    def process(zip_fpath, modality):
+        with bet.producer():
+            return process_image(zip_fpath, modality, args, manifest, cpus, bet)
+
+    with ThreadPoolExecutor(max_workers = args.jobs) as pool:
+        jobs = [
+            pool.submit(process, zip_fpath, modality)
+            for zip_fpath in args.zips for modality in args.modalities
+        ]
+        ok = [job.result() for job in jobs]
+
+    print(f'{sum(ok)} of {len(ok)} images processed in', args.output_dir)
+    if not all(ok):
+        sys.exit(1)
+
+#---------------------------------------------
+if __name__ == '__main__':
+    main()
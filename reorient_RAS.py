@@ -8,6 +8,9 @@ import os, sys
 import numpy as np
 import nibabel as nib
 
+from nifti_reorient import DEFAULT_MAX_MEMORY, save_reoriented
+from stage_trace import stage
+
 def main(args=None):
     
     # Get inputs
@@ -15,6 +18,8 @@ def main(args=None):
     parser.add_argument('--input', type=str, required=True)
     parser.add_argument('--output', type=str, required=True)
     parser.add_argument('--ro-matrix', type=str)
+    parser.add_argument('--stream', action='store_true', default=False, help='Write the output slab by slab, keeping the input data type and scaling.')
+    parser.add_argument('--max-memory', type=float, default=DEFAULT_MAX_MEMORY, help='Slab size in MB for --stream.')
     
     args = parser.parse_args(args if args is not None else sys.argv[1:])
     
@@ -28,18 +33,26 @@ def main(args=None):
     print('Image orientation:', nib.aff2axcodes(IM.affine))
 
     # Reoriented image
-    RO = nib.as_closest_canonical(IM)
-    ref_ori = nib.orientations.io_orientation(RO.affine)
-    print('Reference orientation:', nib.aff2axcodes(RO.affine))
+    if args.stream:
+        with stage('reorient', file = args.input, stream = True):
+            ro_header = save_reoriented(IM, im_ori, args.output, max_memory = args.max_memory)
+        ro_affine, ro_shape = ro_header.get_best_affine(), ro_header.get_data_shape()
+    else:
+        RO = nib.as_closest_canonical(IM)
+        ro_affine, ro_shape = RO.affine, RO.shape
+    ref_ori = nib.orientations.io_orientation(ro_affine)
+    print('Reference orientation:', nib.aff2axcodes(ro_affine))
 
     # Save reoriented image
-    nib.save(RO, args.output)
+    if not args.stream:
+        with stage('reorient', file = args.input):
+            nib.save(RO, args.output)
 
     if args.ro_matrix is not None:
         # Orientation transform from reference to input
         or_ref2in = nib.orientations.ornt_transform(ref_ori, im_ori)
         # Affine transform from input to reference
-        aff_in2ref = nib.orientations.inv_ornt_aff(or_ref2in, np.array(RO.shape).astype(np.int32))
+        aff_in2ref = nib.orientations.inv_ornt_aff(or_ref2in, np.array(ro_shape).astype(np.int32))
         # Save reorientation affine transform 
         np.savetxt(args.ro_matrix, aff_in2ref)
         
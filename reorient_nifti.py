@@ -8,6 +8,9 @@ import os, sys
 import numpy as np
 import nibabel as nib
 
+from nifti_reorient import DEFAULT_MAX_MEMORY, reoriented_header, save_reoriented
+from stage_trace import stage
+
 def decompose_affine(v2w, scaling):
     A = v2w[:3, :3]
     b = v2w[:3, 3]
@@ -27,6 +30,8 @@ def main(args=None):
     parser.add_argument('--output', type=str, required=True)
     parser.add_argument('--ro-matrix', type=str)
     parser.add_argument('--realign-grid', action='store_true', default=False)
+    parser.add_argument('--stream', action='store_true', default=False, help='Write the output slab by slab, keeping the input data type and scaling.')
+    parser.add_argument('--max-memory', type=float, default=DEFAULT_MAX_MEMORY, help='Slab size in MB for --stream.')
     parser.add_argument('--verbose', action='store_true', default=False)
     
     args = parser.parse_args(args if args is not None else sys.argv[1:])
@@ -59,13 +64,20 @@ def main(args=None):
     )
     or_in2ref = nib.orientations.io_orientation(aff_in2ref)
     
-    # Apply reorientation
-    RO_IM = IM.as_reoriented(or_in2ref)
+    # Apply reorientation (header only when streaming)
+    if args.stream:
+        ro_affine = IM.affine @ nib.orientations.inv_ornt_aff(or_in2ref, IM.shape)
+        RO_IM = None
+        ro_header = reoriented_header(IM, or_in2ref, ro_affine)
+    else:
+        RO_IM = IM.as_reoriented(or_in2ref)
+        ro_affine, ro_header = RO_IM.affine, RO_IM.header
+    out_affine = ro_affine
     
     if args.realign_grid:
 
-        imvox = np.array(RO_IM.header.get_zooms()).astype(np.float32)
-        T_im,R_im,S_im = decompose_affine(RO_IM.affine, imvox)
+        imvox = np.array(ro_header.get_zooms()).astype(np.float32)
+        T_im,R_im,S_im = decompose_affine(ro_affine, imvox)
 
         refvox = np.array(REF.header.get_zooms()).astype(np.float32)
         T_ref,R_ref,S_ref = decompose_affine(REF.affine, refvox)
@@ -78,12 +90,16 @@ def main(args=None):
         new_T = np.block([[np.eye(3), shift.reshape(-1,1)],
                       [np.zeros((1, 3)), 1.]]).astype(np.float32)
         new_imaff = new_T @ R_ref @ S_im
-        out = nib.Nifti1Image(RO_IM.get_fdata(), new_imaff, RO_IM.header)
-    else:
-        out = RO_IM
+        out_affine = new_imaff
+        if RO_IM is not None:
+            RO_IM = nib.Nifti1Image(RO_IM.get_fdata(), new_imaff, RO_IM.header)
     
     # Save reoriented image
-    nib.save(out, args.output)
+    with stage('reorient', file = args.input, stream = args.stream):
+        if args.stream:
+            save_reoriented(IM, or_in2ref, args.output, affine = out_affine, max_memory = args.max_memory)
+        else:
+            nib.save(RO_IM, args.output)
     
     # Save reorientation affine transform 
     if args.ro_matrix is not None:
@@ -0,0 +1,193 @@
+#!/usr/bin/env python3
+# Stage-level timing and resource records
+# When MRI_TOOLKIT_TRACE is set to a file path, every `with stage(name):`
+# block appends one record with wall time, CPU time and bytes read/written.
+# Stages run concurrently in threads, so CPU time and I/O are those of the
+# calling thread (work of threads started inside the stage is not counted),
+# and child processes are measured one by one when started with run(), or
+# with waited_children() when another module starts and waits for them.
+# The children_* fields are only written for stages where they were
+# measured. Peak RSS is only known for the whole process. Records are JSON lines, or
+# Chrome trace events (chrome://tracing, Perfetto) when
+# MRI_TOOLKIT_TRACE_FORMAT=chrome. Nothing is measured when it is unset.
+# From the shell: stage_trace.py <name> <command> [args...]
+# Diana Giraldo
+
+import contextlib
+import json
+import os, sys
+import resource
+import subprocess
+import threading
+import time
+
+TRACE_ENV = 'MRI_TOOLKIT_TRACE'
+TRACE_FORMAT_ENV = 'MRI_TOOLKIT_TRACE_FORMAT'
+
+# ru_maxrss is in kB on Linux and bytes on macOS
+RSS_SCALE = 2**20 if sys.platform == 'darwin' else 2**10
+# Own usage of the calling thread where the platform provides it (Linux)
+RUSAGE_THREAD = getattr(resource, 'RUSAGE_THREAD', resource.RUSAGE_SELF)
+IO_PATH = '/proc/thread-self/io' if os.path.exists('/proc/thread-self/io') else '/proc/self/io'
+
+# Active stages of each thread, innermost last
+ACTIVE = threading.local()
+
+def io_counters():
+    try:
+        with open(IO_PATH) as f:
+            counters = dict(line.split(': ') for line in f.read().splitlines())
+        return int(counters['rchar']), int(counters['wchar'])
+    except (OSError, KeyError, ValueError):
+        return 0, 0
+
+def snapshot():
+    own = resource.getrusage(RUSAGE_THREAD)
+    read, written = io_counters()
+    return {
+        'wall': time.time(),
+        'cpu': own.ru_utime + own.ru_stime,
+        'io': (read, written),
+    }
+
+def active_stages():
+    if not hasattr(ACTIVE, 'stages'):
+        ACTIVE.stages = []
+    return ACTIVE.stages
+
+# Children started by run() or inside waited_children(), to tell whether
+# the change in RUSAGE_CHILDREN belongs to a single one
+CHILDREN_LOCK = threading.Lock()
+CHILDREN = {'running': 0, 'started': 0}
+
+def start_child():
+    with CHILDREN_LOCK:
+        CHILDREN['started'] += 1
+        CHILDREN['running'] += 1
+        return CHILDREN['running'] == 1, CHILDREN['started']
+
+def end_child():
+    with CHILDREN_LOCK:
+        CHILDREN['running'] -= 1
+        return CHILDREN['started']
+
+# Add the usage of child processes to the stages open in the calling thread
+def charge_children(cpu, read, written, maxrss = None):
+    for children in active_stages():
+        children['measured'] = True
+        children['cpu'] += cpu
+        children['read'] += read
+        children['written'] += written
+        if maxrss is not None:
+            children['maxrss'] = max(children['maxrss'] or 0, maxrss)
+
+# Run a command and charge its resource usage to the stages open in the
+# calling thread. Returns the exit status.
+def run(args, **kwargs):
+    start_child()
+    try:
+        proc = subprocess.Popen(args, **kwargs)
+        try:
+            _, status, usage = os.wait4(proc.pid, 0)
+        except BaseException:
+            proc.kill()
+            proc.wait()
+            raise
+    finally:
+        end_child()
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    # Block I/O, in 512-byte blocks
+    charge_children(
+        usage.ru_utime + usage.ru_stime, usage.ru_inblock * 512,
+        usage.ru_oublock * 512, usage.ru_maxrss,
+    )
+    return proc.returncode
+
+# Charge the child processes started and waited for inside the block (e.g.
+# by another module) to the stages open in the calling thread, from the
+# change in RUSAGE_CHILDREN. That change is only theirs when no other child
+# process was started meanwhile, so nothing is charged otherwise. The peak
+# RSS of the children is known only when it exceeds that of earlier ones.
+@contextlib.contextmanager
+def waited_children():
+    if not active_stages():
+        yield
+        return
+
+    alone, started = start_child()
+    before = resource.getrusage(resource.RUSAGE_CHILDREN)
+    try:
+        yield
+    finally:
+        after = resource.getrusage(resource.RUSAGE_CHILDREN)
+        if end_child() == started and alone:
+            charge_children(
+                (after.ru_utime + after.ru_stime) - (before.ru_utime + before.ru_stime),
+                (after.ru_inblock - before.ru_inblock) * 512,
+                (after.ru_oublock - before.ru_oublock) * 512,
+                after.ru_maxrss if after.ru_maxrss > before.ru_maxrss else None,
+            )
+
+def write_record(fpath, record, fmt):
+    if fmt == 'chrome':
+        event = {
+            'name': record['name'], 'ph': 'X', 'pid': record['pid'], 'tid': record['tid'],
+            'ts': record['start'] * 1e6, 'dur': record['wall_s'] * 1e6,
+            'args': {k: v for k, v in record.items() if k not in ('name', 'pid', 'tid', 'start')},
+        }
+        # Chrome accepts a JSON array without the closing bracket
+        line = ('' if os.path.isfile(fpath) and os.path.getsize(fpath) else '[\n') + json.dumps(event) + ',\n'
+    else:
+        line = json.dumps(record) + '\n'
+    with open(fpath, 'a') as f:
+        f.write(line)
+
+@contextlib.contextmanager
+def stage(name, **meta):
+    fpath = os.environ.get(TRACE_ENV)
+    if not fpath:
+        yield
+        return
+
+    before = snapshot()
+    children = {'measured': False, 'cpu': 0.0, 'read': 0, 'written': 0, 'maxrss': None}
+    active_stages().append(children)
+    try:
+        yield
+    finally:
+        active_stages().pop()
+        after = snapshot()
+        record = {
+            'name': name,
+            'start': before['wall'],
+            'wall_s': after['wall'] - before['wall'],
+            'cpu_s': after['cpu'] - before['cpu'],
+            'read_bytes': after['io'][0] - before['io'][0],
+            'write_bytes': after['io'][1] - before['io'][1],
+            'process_peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * RSS_SCALE / 2**20,
+            'pid': os.getpid(),
+            'tid': threading.get_ident(),
+            **meta,
+        }
+        if children['measured']:
+            record['children_cpu_s'] = children['cpu']
+            record['children_read_bytes'] = children['read']
+            record['children_write_bytes'] = children['written']
+        if children['maxrss'] is not None:
+            record['children_peak_rss_mb'] = children['maxrss'] * RSS_SCALE / 2**20
+        write_record(fpath, record, os.environ.get(TRACE_FORMAT_ENV, 'jsonl'))
+
+#---------------------------------------------
+
+def main(args=None):
+    args = args if args is not None else sys.argv[1:]
+    if len(args) < 2:
+        raise ValueError('Usage: stage_trace.py <name> <command> [args...]')
+
+    with stage(args[0], command = ' '.join(args[1:])):
+        status = run(args[1:])
+    sys.exit(status)
+
+#---------------------------------------------
+if __name__ == '__main__':
+    main()
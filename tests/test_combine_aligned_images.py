@@ -0,0 +1,108 @@
+# Tests of combine_aligned_images.py through its command line
+# Diana Giraldo
+
+import os, sys
+import subprocess
+
+import pytest
+
+np = pytest.importorskip('numpy')
+nib = pytest.importorskip('nibabel')
+pytest.importorskip('scipy')
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+import combine_aligned_images as combine
+
+SCRIPT = os.path.join(REPO_DIR, 'combine_aligned_images.py')
+
+def write_inputs(tmp_path, shape = (12, 10, 8), n_inputs = 3):
+    rng = np.random.default_rng(0)
+    fpaths, data = [], []
+    for i in range(n_inputs):
+        x = rng.random(shape) * 100
+        fpath = str(tmp_path / f'img{i}.nii')
+        nib.save(nib.Nifti1Image(x.astype(np.float32), np.eye(4)), fpath)
+        fpaths.append(fpath)
+        data.append(x.astype(np.float32).astype(np.float64))
+    return fpaths, data
+
+@pytest.mark.parametrize('method', ['fba', 'median', 'average'])
+@pytest.mark.parametrize('shape', [(12, 10, 8), (12, 10, 8, 3)])
+def test_cli_methods(tmp_path, method, shape):
+    fpaths, data = write_inputs(tmp_path, shape = shape)
+    out_fpath = str(tmp_path / f'{method}.nii.gz')
+    subprocess.run(
+        [sys.executable, SCRIPT, '--inputs', *fpaths, '--output', out_fpath, '--method', method],
+        check = True, cwd = str(tmp_path),
+    )
+
+    out = nib.load(out_fpath).get_fdata()
+    assert out.shape == shape
+    assert np.all(np.isfinite(out))
+    if method == 'median':
+        np.testing.assert_allclose(out, np.median(data, axis = 0), rtol = 1e-5)
+    elif method == 'average':
+        np.testing.assert_allclose(out, np.mean(data, axis = 0), rtol = 1e-5)
+
+@pytest.mark.parametrize('method', ['fba', 'median', 'average'])
+def test_combine_images_loader(tmp_path, method):
+    fpaths, data = write_inputs(tmp_path)
+    load = lambda fpath: np.asarray(nib.load(fpath).dataobj, dtype=np.float64)
+
+    out = combine.combine_images(fpaths, method = method, loader = load)
+    expected = combine.combine_images(data, method = method)
+    assert out is not None
+    np.testing.assert_allclose(out, expected, rtol = 1e-6, atol = 1e-6)
+
+@pytest.mark.parametrize('method', ['median', 'average'])
+def test_combine_stack_fovs(method):
+    rng = np.random.default_rng(1)
+    stack = rng.random((3, 6, 5, 4)) * 100
+    fov_stack = rng.random(stack.shape) > 0.3
+    fov_stack[:, 0] = False
+
+    out = combine.combine_stack(stack, method = method, fov_stack = fov_stack)
+    inside = np.where(fov_stack, stack, np.nan)
+    with np.errstate(invalid = 'ignore'), pytest.warns(RuntimeWarning):
+        expected = np.nanmedian(inside, axis = 0) if method == 'median' else np.nanmean(inside, axis = 0)
+    np.testing.assert_allclose(out, np.nan_to_num(expected))
+
+def test_build_stack_reuse(tmp_path):
+    fpaths, data = write_inputs(tmp_path)
+    stack_path = str(tmp_path / 'stack.npy')
+    load = lambda fpath: np.asarray(nib.load(fpath).dataobj, dtype=np.float64)
+
+    stack = combine.build_stack(fpaths, stack_path, load)
+    np.testing.assert_allclose(stack[0], data[0])
+    mtime = os.stat(stack_path).st_mtime_ns
+    del stack
+
+    # Same inputs: reused
+    combine.build_stack(fpaths, stack_path, load)
+    assert os.stat(stack_path).st_mtime_ns == mtime
+
+    # Reordered or different inputs: rebuilt
+    stack = combine.build_stack(fpaths[::-1], stack_path, load)
+    np.testing.assert_allclose(stack[0], data[-1])
+    del stack
+    stack = combine.build_stack(fpaths[:2], stack_path, load)
+    assert stack.shape[0] == 2
+
+def test_cli_fba_4d_gzipped(tmp_path):
+    fpaths, _ = write_inputs(tmp_path, shape = (12, 10, 8, 4))
+    gz_fpaths = []
+    for fpath in fpaths:
+        img = nib.load(fpath)
+        gz_fpaths.append(fpath + '.gz')
+        nib.save(nib.Nifti1Image(np.asarray(img.dataobj), img.affine), gz_fpaths[-1])
+
+    outputs = []
+    for inputs in [fpaths, gz_fpaths]:
+        outputs.append(str(tmp_path / f'fba{len(outputs)}.nii'))
+        subprocess.run(
+            [sys.executable, SCRIPT, '--inputs', *inputs, '--output', outputs[-1], '--method', 'fba'],
+            check = True, cwd = str(tmp_path),
+        )
+    np.testing.assert_array_equal(nib.load(outputs[0]).get_fdata(), nib.load(outputs[1]).get_fdata())